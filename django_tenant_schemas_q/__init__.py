@@ -0,0 +1 @@
+default_app_config = "django_tenant_schemas_q.apps.DjangoTenantSchemasQConfig"
@@ -0,0 +1,25 @@
+from django.apps import AppConfig
+
+from django_tenant_schemas_q.conf import TenantConf
+
+
+class DjangoTenantSchemasQConfig(AppConfig):
+    name = "django_tenant_schemas_q"
+    verbose_name = "Django Tenant Schemas Q"
+
+    def ready(self):
+        if TenantConf.SCHEDULE_INDEX:
+            from django.db.models.signals import post_save, post_delete
+            from django_q.models import Schedule
+            from django_tenant_schemas_q.signals import index_schedule, unindex_schedule
+
+            post_save.connect(index_schedule, sender=Schedule, dispatch_uid="django_tenant_schemas_q_index")
+            post_delete.connect(unindex_schedule, sender=Schedule, dispatch_uid="django_tenant_schemas_q_unindex")
+        if TenantConf.BLOB_THRESHOLD:
+            from django.db.models.signals import post_delete
+            from django_q.models import Task, Success, Failure
+            from django_tenant_schemas_q.blobs import delete_task_blobs
+
+            for model in (Task, Success, Failure):
+                post_delete.connect(
+                    delete_task_blobs, sender=model, dispatch_uid=f"django_tenant_schemas_q_blobs_{model.__name__}")
@@ -0,0 +1,328 @@
+# Standard
+import sys
+import json
+import platform
+from datetime import timedelta
+from time import sleep, time, perf_counter
+
+# Django
+from django.utils import timezone
+from tenant_schemas.utils import schema_context, get_tenant_model
+
+# Local
+from django_q.conf import Conf
+from django_q.brokers import get_broker
+from django_q.brokers.redis_broker import Redis
+from django_q.models import Task, Schedule
+from django_tenant_schemas_q.conf import TenantConf
+from django_tenant_schemas_q.utils import QUtilities
+from django_tenant_schemas_q import codec
+from django_tenant_schemas_q.cluster import MultiTenantCluster, scheduler, scheduled_schemas
+
+
+def stamp():
+    """
+    Benchmark task, returns the time the worker ran it at
+    """
+    return time()
+
+
+def setup_tenants(count, prefix="bench"):
+    """
+    Makes sure count benchmark tenants exist, creating their schemas when needed
+    :return: the schema names of the benchmark tenants
+    """
+    tenant_model = get_tenant_model()
+    schema_names = [f"{prefix}{i}" for i in range(count)]
+    existing = set(
+        tenant_model.objects.filter(schema_name__in=schema_names).values_list("schema_name", flat=True)
+    )
+    for schema_name in schema_names:
+        if schema_name not in existing:
+            tenant_model(schema_name=schema_name, domain_url=f"{schema_name}.benchmark.local").save()
+    return schema_names
+
+
+def teardown_tenants(schema_names):
+    """
+    Drops the benchmark tenants and their schemas
+    """
+    for tenant in get_tenant_model().objects.filter(schema_name__in=schema_names):
+        tenant.delete(force_drop=True)
+
+
+def percentiles(values):
+    """
+    Summary of a list of durations in milliseconds
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(p):
+        return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+def enqueue_rate(schema_names, count, broker):
+    """
+    Measures how many tasks per second are enqueued one by one and in bulk
+    """
+    broker.purge_queue()
+    per_schema = max(count // len(schema_names), 1)
+    start = perf_counter()
+    for schema_name in schema_names:
+        for i in range(per_schema):
+            QUtilities.add_async_task(
+                "django_tenant_schemas_q.benchmark.stamp", schema_name=schema_name, broker=broker)
+    single = perf_counter() - start
+    broker.purge_queue()
+
+    start = perf_counter()
+    for schema_name in schema_names:
+        QUtilities.add_async_tasks_bulk(
+            "django_tenant_schemas_q.benchmark.stamp",
+            [()] * per_schema, schema_name=schema_name, broker=broker)
+    bulk = perf_counter() - start
+    broker.purge_queue()
+
+    total = per_schema * len(schema_names)
+    return {
+        "tasks": total,
+        "single_per_second": round(total / single, 1),
+        "bulk_per_second": round(total / bulk, 1),
+    }
+
+
+def listen(broker):
+    """
+    Subscribes to the announcements of the monitor, None if they aren't available
+    """
+    if not TenantConf.NOTIFY or not isinstance(broker, Redis):
+        return None
+    pubsub = broker.connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe(QUtilities.done_channel(broker, "*"))
+    return pubsub
+
+
+def wait_saved(task_ids, pubsub, timeout):
+    """
+    Waits until every task has been saved by the monitor
+    :param task_ids: the ids of the tasks per schema
+    :return: the time every task was seen saved at
+    """
+    saved = {}
+    pending = {task_id for ids in task_ids.values() for task_id in ids}
+    deadline = time() + timeout
+    while pending and time() < deadline:
+        if pubsub:
+            message = pubsub.get_message(timeout=0.1)
+            if message:
+                task_id = message["data"].decode()
+                if task_id in pending:
+                    pending.discard(task_id)
+                    saved[task_id] = time()
+            continue
+        # without announcements poll the task tables
+        for schema_name, ids in task_ids.items():
+            with schema_context(schema_name):
+                found = Task.objects.filter(id__in=[i for i in ids if i in pending]).values_list("id", flat=True)
+                now = time()
+                for task_id in found:
+                    pending.discard(task_id)
+                    saved[task_id] = now
+        sleep(0.01)
+    return saved
+
+
+def throughput(schema_names, count, workers, broker, timeout=300):
+    """
+    Runs count tasks spread over the schemas through a cluster of the given number of workers
+    and measures the rate and the latencies of every stage
+    """
+    broker.purge_queue()
+    per_schema = max(count // len(schema_names), 1)
+    # the cluster reads its size from the configuration, the caller gets theirs back
+    configured_workers, Conf.WORKERS = Conf.WORKERS, workers
+    try:
+        pubsub = listen(broker)
+        cluster = MultiTenantCluster(broker=broker)
+        cluster.start()
+        try:
+            started = time()
+            task_ids = {}
+            for schema_name in schema_names:
+                task_ids[schema_name] = QUtilities.add_async_tasks_bulk(
+                    "django_tenant_schemas_q.benchmark.stamp",
+                    [()] * per_schema, schema_name=schema_name, broker=broker)
+            saved = wait_saved(task_ids, pubsub, timeout)
+            finished = time()
+        finally:
+            cluster.stop()
+            if pubsub:
+                pubsub.close()
+    finally:
+        Conf.WORKERS = configured_workers
+
+    queued, executed, persisted, total = [], [], [], []
+    for schema_name, ids in task_ids.items():
+        with schema_context(schema_name):
+            for task in Task.objects.filter(id__in=ids, success=True):
+                # tasks are stamped as started when they are enqueued
+                sent = task.started.timestamp()
+                begun = task.result
+                stopped = task.stopped.timestamp()
+                queued.append(begun - sent)
+                executed.append(stopped - begun)
+                if task.id in saved:
+                    persisted.append(saved[task.id] - stopped)
+                    total.append(saved[task.id] - sent)
+            Task.objects.filter(id__in=ids).delete()
+
+    done = len(saved)
+    span = max(saved.values()) - min(saved.values()) if done > 1 else 0
+    return {
+        "workers": workers,
+        "tasks": per_schema * len(schema_names),
+        "completed": done,
+        "seconds": round(finished - started, 3),
+        "tasks_per_second": round(done / (finished - started), 1),
+        "tasks_per_second_per_worker": round(done / (finished - started) / workers, 1),
+        "persisted_per_second": round(done / span, 1) if span else None,
+        "latency_ms": {
+            "enqueue_to_worker": percentiles(queued),
+            "worker": percentiles(executed),
+            "worker_to_saved": percentiles(persisted),
+            "total": percentiles(total),
+        },
+    }
+
+
+def scheduler_sweep(schema_names, steps, broker):
+    """
+    Times the lookup of the schemas to visit and a scheduler sweep over a growing number of schemas,
+    each holding a schedule that isn't due
+    """
+    next_run = timezone.now() + timedelta(days=1)
+    for schema_name in schema_names:
+        with schema_context(schema_name):
+            Schedule.objects.get_or_create(
+                name="benchmark",
+                defaults={"func": "django_tenant_schemas_q.benchmark.stamp", "next_run": next_run},
+            )
+    start = perf_counter()
+    scheduled_schemas()
+    results = [{"lookup_seconds": round(perf_counter() - start, 4)}]
+    for step in steps:
+        start = perf_counter()
+        scheduler(broker, schema_names=schema_names[:step])
+        results.append({"schemas": step, "seconds": round(perf_counter() - start, 4)})
+    for schema_name in schema_names:
+        with schema_context(schema_name):
+            Schedule.objects.filter(name="benchmark").delete()
+    return results
+
+
+def task_shapes():
+    """
+    Task packages as prepare_task builds them, from a bare call to one carrying a sizeable payload
+    """
+    base = {
+        "id": "2f5d0f4e5f6a4f0e9d3c2b1a09876543",
+        "name": "thirteen-alpha-winter-bacon",
+        "func": "app.tasks.send_notification",
+        "started": timezone.now(),
+        "cached": False,
+        "ack_failure": False,
+    }
+    return {
+        "bare": dict(base, args=(), kwargs={"schema_name": "tenant"}),
+        "typical": dict(
+            base,
+            args=(42, "welcome"),
+            kwargs={"schema_name": "tenant", "user_id": 1234, "channels": ["email", "push"], "force": False},
+            group="notifications",
+        ),
+        "payload": dict(
+            base,
+            args=([{"id": i, "name": f"item {i}", "price": i * 1.5, "tags": ["a", "b"]} for i in range(500)],),
+            kwargs={"schema_name": "tenant"},
+        ),
+    }
+
+
+def codecs(iterations=2000):
+    """
+    Compares the encoding and decoding speed and the package size of the available codecs
+    """
+    names = ["pickle"] + [name for name in codec.CODECS if codec.available(name)]
+    results = []
+    for shape, task in task_shapes().items():
+        for name in names:
+            pack = codec.dumps(task, name)
+            start = perf_counter()
+            for __ in range(iterations):
+                codec.dumps(task, name)
+            dumps = perf_counter() - start
+            start = perf_counter()
+            for __ in range(iterations):
+                codec.loads(pack)
+            loads = perf_counter() - start
+            results.append({
+                "shape": shape,
+                "codec": name,
+                "bytes": len(pack),
+                "dumps_per_second": round(iterations / dumps, 1),
+                "loads_per_second": round(iterations / loads, 1),
+            })
+    return results
+
+
+def run(tenants=10, tasks=1000, workers=(1, 2, 4), keep=False, broker=None):
+    """
+    Runs the whole benchmark suite
+    :return: the results as a dictionary that can be dumped to json
+    """
+    broker = broker or get_broker()
+    schema_names = setup_tenants(tenants)
+    steps = sorted({max(tenants // 10, 1), max(tenants // 2, 1), tenants})
+    try:
+        results = {
+            "meta": {
+                "timestamp": timezone.now().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "broker": f"{broker.__class__.__module__}.{broker.__class__.__name__}",
+                "tenants": tenants,
+                "tasks": tasks,
+                "options": {
+                    key: value for key, value in Conf.conf.items() if isinstance(value, (int, float, bool))
+                },
+            },
+            "codecs": codecs(),
+            "enqueue": enqueue_rate(schema_names, tasks, broker),
+            "throughput": [throughput(schema_names, tasks, count, broker) for count in workers],
+            "scheduler": scheduler_sweep(schema_names, steps, broker),
+        }
+    finally:
+        if not keep:
+            teardown_tenants(schema_names)
+    return results
+
+
+def dump(results, output=None):
+    """
+    Writes the results as json to a file or stdout
+    """
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
@@ -0,0 +1,231 @@
+# Standard
+import os
+import pickle
+import tempfile
+import importlib
+from time import time
+from uuid import uuid4
+
+# Django
+from django.db.models import QuerySet
+
+# Local
+from django_q.conf import logger
+from django_tenant_schemas_q.conf import TenantConf
+
+
+class BlobStore(object):
+    """
+    Keeps the large arguments and results of tasks out of the broker and the database.
+    Subclass it and point BLOB_STORE at the subclass to keep them somewhere else.
+    """
+
+    def put(self, data, transient=False):
+        """
+        Stores the bytes and returns the key to get them back with
+        :param transient: the blob belongs to a task that only lives in the cache and is removed by purge
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def purge(self, age):
+        """
+        Deletes the transient blobs older than age seconds
+        """
+        raise NotImplementedError
+
+
+class FileSystemStore(BlobStore):
+    """
+    Keeps the blobs as files under BLOB_PATH, which every cluster and client has to share
+    """
+
+    def __init__(self, path=None):
+        self.path = path or TenantConf.BLOB_PATH or os.path.join(tempfile.gettempdir(), "django_tenant_schemas_q")
+
+    def file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def put(self, data, transient=False):
+        key = f"{'t' if transient else 'p'}{uuid4().hex}"
+        path = self.file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # readers never see a partial blob
+        temp = f"{path}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+        return key
+
+    def get(self, key):
+        with open(self.file(key), "rb") as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self.file(key))
+        except FileNotFoundError:
+            pass
+
+    def purge(self, age):
+        deadline = time() - age
+        count = 0
+        for root, __, files in os.walk(self.path):
+            for name in files:
+                if not name.startswith("t"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        count += 1
+                except FileNotFoundError:
+                    continue
+        return count
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        module, cls = TenantConf.BLOB_STORE.rsplit(".", 1)
+        _store = getattr(importlib.import_module(module), cls)()
+    return _store
+
+
+def is_ref(value):
+    return isinstance(value, dict) and "__blob__" in value
+
+
+def transient(task):
+    """
+    Whether a task only lives in the cache or isn't saved at all, so nothing deletes its blobs with a row
+    """
+    if task.get("save") is False:
+        return True
+    if task.get("iter_count"):
+        return bool(task.get("iter_cached"))
+    return bool(task.get("cached"))
+
+
+def offload(value, transient=False):
+    """
+    Puts a value larger than BLOB_THRESHOLD bytes pickled in the blob store
+    :return: a reference to the blob or the value itself
+    """
+    if not TenantConf.BLOB_THRESHOLD or value is None or isinstance(value, (bool, int, float)):
+        return value
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) <= TenantConf.BLOB_THRESHOLD:
+        return value
+    return {"__blob__": get_store().put(data, transient), "size": len(data)}
+
+
+def offload_arguments(args, kwargs, transient=False):
+    """
+    Offloads the large arguments of a task, the schema name always stays inline
+    """
+    if not TenantConf.BLOB_THRESHOLD:
+        return args, kwargs
+    args = tuple(offload(arg, transient) for arg in args)
+    kwargs = {key: value if key == "schema_name" else offload(value, transient) for key, value in kwargs.items()}
+    return args, kwargs
+
+
+def fetch(value):
+    """
+    Gets the value back from a reference, anything else is returned as it is
+    """
+    if not is_ref(value):
+        return value
+    return pickle.loads(get_store().get(value["__blob__"]))
+
+
+def fetch_arguments(args, kwargs):
+    if not any(is_ref(arg) for arg in args) and not any(is_ref(value) for value in kwargs.values()):
+        return args, kwargs
+    return tuple(fetch(arg) for arg in args), {key: fetch(value) for key, value in kwargs.items()}
+
+
+def resolve(value):
+    """
+    Fetches a result, or the results of a group
+    """
+    if isinstance(value, list):
+        return [fetch(v) for v in value]
+    return fetch(value)
+
+
+def resolve_task(task):
+    """
+    Fetches the result of a task model instance, or of a list or queryset of them
+    """
+    if isinstance(task, (list, QuerySet)):
+        for t in task:
+            resolve_task(t)
+    elif task is not None:
+        task.result = resolve(task.result)
+    return task
+
+
+def refs(*values):
+    """
+    The blob keys referred to by the values, their items and the items of their lists or dicts
+    """
+    keys = []
+    for value in values:
+        if is_ref(value):
+            keys.append(value["__blob__"])
+        elif isinstance(value, (list, tuple)):
+            keys.extend(refs(*value))
+        elif isinstance(value, dict):
+            keys.extend(refs(*value.values()))
+    return keys
+
+
+def delete(keys):
+    """
+    Deletes blobs by their keys
+    """
+    if not keys:
+        return
+    store = get_store()
+    for key in keys:
+        try:
+            store.delete(key)
+        except Exception as e:
+            logger.error(e)
+
+
+def delete_task_blobs(sender, instance, **kwargs):
+    """
+    Deletes the blobs of a deleted task
+    """
+    delete(refs(instance.args, instance.kwargs, instance.result))
+
+
+def discard(task):
+    """
+    Deletes the blobs of a task package the monitor doesn't save. Cached tasks keep theirs until purged
+    and fan out tasks keep their result for the reduce task.
+    """
+    if not TenantConf.BLOB_THRESHOLD or task.get("cached") or task.get("iter_cached"):
+        return
+    values = [task.get("args", ()), task.get("kwargs", {})]
+    if not task.get("fanout"):
+        values.append(task.get("result"))
+    delete(refs(*values))
+
+
+def purge(age=86400):
+    """
+    Deletes the blobs of cached tasks older than age seconds. Schedule it with an age above the cache timeouts
+    """
+    return get_store().purge(age)
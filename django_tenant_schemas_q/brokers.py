@@ -0,0 +1,261 @@
+# Standard
+from time import time
+
+# local
+from django_q.conf import Conf
+from django_q.brokers.redis_broker import Redis
+from django_tenant_schemas_q.conf import TenantConf
+
+
+# Appends a task to the queue of its schema and puts the schema in the ring when it becomes active
+ENQUEUE = """
+local n = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[2])
+if n == 1 and redis.call('SISMEMBER', KEYS[3], ARGV[2]) == 0 then
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+    redis.call('RPUSH', KEYS[4], 1)
+    redis.call('LTRIM', KEYS[4], 0, 0)
+end
+return n
+"""
+
+# Visits the active schemas of the ring in turn and takes up to their weight in tasks from each.
+# Schemas at their in flight cap are parked until one of their tasks is released.
+DEQUEUE = """
+local ring, parked, wake, weights, sequence = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local prefix, default_weight = ARGV[1], tonumber(ARGV[2])
+local cap, now, ttl, bulk = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+if redis.call('LLEN', ring) == 0 and redis.call('SCARD', parked) > 0 then
+    for _, schema in ipairs(redis.call('SMEMBERS', parked)) do
+        redis.call('RPUSH', ring, schema)
+    end
+    redis.call('DEL', parked)
+end
+local tasks = {}
+local turns = redis.call('LLEN', ring)
+while turns > 0 and #tasks < bulk * 2 do
+    turns = turns - 1
+    local schema = redis.call('LPOP', ring)
+    local queue = prefix .. schema
+    local inflight = queue .. ':inflight'
+    local quantum = tonumber(redis.call('HGET', weights, schema) or default_weight)
+    if cap > 0 then
+        redis.call('ZREMRANGEBYSCORE', inflight, '-inf', now - ttl)
+        quantum = math.min(quantum, cap - redis.call('ZCARD', inflight))
+    end
+    if quantum <= 0 then
+        redis.call('SADD', parked, schema)
+    else
+        for i = 1, quantum do
+            local task = redis.call('LPOP', queue)
+            if not task then
+                break
+            end
+            local ack = false
+            if cap > 0 then
+                ack = schema .. ':' .. redis.call('INCR', sequence)
+                redis.call('ZADD', inflight, now, ack)
+            end
+            table.insert(tasks, ack)
+            table.insert(tasks, task)
+        end
+        if redis.call('LLEN', queue) > 0 then
+            redis.call('RPUSH', ring, schema)
+        end
+    end
+end
+if #tasks == 0 then
+    redis.call('DEL', wake)
+end
+return tasks
+"""
+
+# Releases an in flight task and puts its schema back in the ring if it was parked
+RELEASE = """
+local prefix, schema, ack = ARGV[1], ARGV[2], ARGV[3]
+redis.call('ZREM', prefix .. schema .. ':inflight', ack)
+if redis.call('SREM', KEYS[2], schema) == 1 then
+    if redis.call('LLEN', prefix .. schema) > 0 then
+        redis.call('RPUSH', KEYS[1], schema)
+        redis.call('RPUSH', KEYS[3], 1)
+        redis.call('LTRIM', KEYS[3], 0, 0)
+    else
+        redis.call('DEL', prefix .. schema .. ':inflight')
+    end
+end
+"""
+
+# Puts a task back at the front of the queue of its schema, releasing its in flight slot
+REQUEUE = """
+local ring, parked, wake, schemas = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local prefix, schema, ack, task = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local queue = prefix .. schema
+local n = redis.call('LPUSH', queue, task)
+redis.call('SADD', schemas, schema)
+local unparked = 0
+if ack ~= '' then
+    redis.call('ZREM', queue .. ':inflight', ack)
+    unparked = redis.call('SREM', parked, schema)
+end
+if unparked == 1 or (n == 1 and redis.call('SISMEMBER', parked, schema) == 0) then
+    redis.call('RPUSH', ring, schema)
+    redis.call('RPUSH', wake, 1)
+    redis.call('LTRIM', wake, 0, 0)
+end
+return n
+"""
+
+
+class FairRedis(Redis):
+    """
+    Redis broker with a queue per schema. Tasks are dequeued with weighted round robin over the schemas
+    that have tasks waiting, so a single tenant can't starve the others. Idle schemas cost nothing.
+
+    Set 'broker_class': 'django_tenant_schemas_q.brokers.FairRedis' in Q_CLUSTER to use it.
+    """
+
+    def __init__(self, list_key: str = Conf.PREFIX):
+        super(FairRedis, self).__init__(list_key=list_key)
+        self.setup()
+
+    def __setstate__(self, state):
+        super(FairRedis, self).__setstate__(state)
+        self.setup()
+
+    def setup(self):
+        self.schema_prefix = f"{self.list_key}:t:"
+        self.ring_key = f"{self.list_key}:ring"
+        self.parked_key = f"{self.list_key}:parked"
+        self.wake_key = f"{self.list_key}:wake"
+        self.weights_key = f"{self.list_key}:weights"
+        self.schemas_key = f"{self.list_key}:schemas"
+        self.sequence_key = f"{self.list_key}:sequence"
+        self.enqueue_script = self.connection.register_script(ENQUEUE)
+        self.dequeue_script = self.connection.register_script(DEQUEUE)
+        self.release_script = self.connection.register_script(RELEASE)
+        self.requeue_script = self.connection.register_script(REQUEUE)
+
+    def publish_weights(self):
+        """
+        Stores the configured TENANT_WEIGHTS where the dequeue script can read them
+        """
+        pipe = self.connection.pipeline()
+        pipe.delete(self.weights_key)
+        if TenantConf.TENANT_WEIGHTS:
+            pipe.hset(self.weights_key, mapping=TenantConf.TENANT_WEIGHTS)
+        pipe.execute()
+
+    def schema_queue(self, schema_name):
+        return f"{self.schema_prefix}{schema_name}"
+
+    def enqueue_keys(self, schema_name):
+        return [
+            self.schema_queue(schema_name),
+            self.ring_key,
+            self.parked_key,
+            self.wake_key,
+            self.schemas_key,
+        ]
+
+    def enqueue(self, task, schema_name="", client=None):
+        """
+        Puts a task in the queue of its schema
+        :param client: an optional pipeline to send the command with
+        """
+        return self.enqueue_script(
+            keys=self.enqueue_keys(schema_name), args=[task, schema_name], client=client
+        )
+
+    def enqueue_many(self, tasks, schema_names):
+        """
+        Puts a list of tasks in the queues of their schemas in a single round trip
+        :param schema_names: the schema of every task
+        """
+        pipe = self.connection.pipeline(transaction=False)
+        for task, schema_name in zip(tasks, schema_names):
+            self.enqueue(task, schema_name=schema_name, client=pipe)
+        return pipe.execute()
+
+    async def aenqueue_many(self, client, tasks, schema_names):
+        """
+        Puts a list of tasks in the queues of their schemas in a single round trip of an asyncio redis client
+        """
+        script = client.register_script(ENQUEUE)
+        pipe = client.pipeline(transaction=False)
+        for task, schema_name in zip(tasks, schema_names):
+            await script(keys=self.enqueue_keys(schema_name), args=[task, schema_name], client=pipe)
+        return await pipe.execute()
+
+    def dequeue(self):
+        tasks = self.dequeue_script(
+            keys=[
+                self.ring_key,
+                self.parked_key,
+                self.wake_key,
+                self.weights_key,
+                self.sequence_key,
+            ],
+            args=[
+                self.schema_prefix,
+                TenantConf.TENANT_WEIGHT,
+                TenantConf.TENANT_MAX_IN_FLIGHT,
+                time(),
+                Conf.RETRY,
+                Conf.BULK,
+            ],
+        )
+        if tasks:
+            return [
+                (ack_id.decode() if ack_id else None, task)
+                for ack_id, task in zip(tasks[::2], tasks[1::2])
+            ]
+        # wait for a schema to become active
+        self.connection.blpop(self.wake_key, 1)
+
+    def acknowledge(self, task_id):
+        """
+        Releases the in flight slot of a task. Without TENANT_MAX_IN_FLIGHT tasks have no slot and no ack id
+        """
+        if not task_id:
+            return
+        schema_name, __ = task_id.rsplit(":", 1)
+        self.release_script(
+            keys=[self.ring_key, self.parked_key, self.wake_key],
+            args=[self.schema_prefix, schema_name, task_id],
+        )
+
+    def requeue(self, tasks):
+        """
+        Puts tasks that were dequeued but never started back at the front of their schema queues
+        :param tasks: tuples of the ack id, the package and the schema name, in the order they were dequeued
+        """
+        pipe = self.connection.pipeline(transaction=False)
+        for ack_id, task, schema_name in reversed(tasks):
+            self.requeue_script(
+                keys=[self.ring_key, self.parked_key, self.wake_key, self.schemas_key],
+                args=[self.schema_prefix, schema_name, ack_id or "", task],
+                client=pipe,
+            )
+        return pipe.execute()
+
+    def fail(self, task_id):
+        self.acknowledge(task_id)
+
+    def schemas(self):
+        return [s.decode() for s in self.connection.smembers(self.schemas_key)]
+
+    def queue_size(self):
+        pipe = self.connection.pipeline()
+        for schema_name in self.schemas():
+            pipe.llen(self.schema_queue(schema_name))
+        return sum(pipe.execute())
+
+    def delete_queue(self):
+        keys = [self.ring_key, self.parked_key, self.wake_key, self.schemas_key, self.sequence_key]
+        for schema_name in self.schemas():
+            keys.append(self.schema_queue(schema_name))
+            keys.append(f"{self.schema_queue(schema_name)}:inflight")
+        return self.connection.delete(*keys)
+
+    def purge_queue(self):
+        return self.delete_queue()
@@ -5,21 +5,42 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 # Standard
+import os
 import ast
+import asyncio
 import uuid
 import signal
 import socket
+import threading
 import traceback
+import zlib
 import importlib
-from time import sleep
+from queue import Empty, Full
+from time import sleep, time, perf_counter, monotonic
+from functools import lru_cache
+from contextlib import contextmanager
+from collections import namedtuple
+from datetime import timedelta
+from collections.abc import Hashable
+from concurrent.futures import ThreadPoolExecutor
 from inspect import getfullargspec
-from multiprocessing import Event, Process, Value, current_process
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import Event, Pipe, Process, Value, current_process
 
 # external
 import arrow
+from asgiref.sync import sync_to_async
 from croniter import croniter
 from tenant_schemas.utils import schema_context, get_tenant_model
 
+# optional
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
+
 # Django
 from django import db
 from django.conf import settings
@@ -30,6 +51,7 @@ from django.utils.translation import gettext_lazy as _
 from django_q.queues import Queue
 from django_q.brokers import get_broker
 from django_q.brokers.orm import ORM
+from django_q.brokers.redis_broker import Redis
 from django_q.humanhash import humanize
 from django_q.signals import pre_execute
 from django_q.status import Stat, Status
@@ -37,7 +59,21 @@ from django_q.models import Task, Success, Schedule
 from django_q.signing import SignedPackage, BadSignature
 from django_q.conf import Conf, logger, psutil, get_ppid, error_reporter
 from django_q.cluster import close_old_django_connections, set_cpu_affinity
+from django_tenant_schemas_q.conf import TenantConf
 from django_tenant_schemas_q.utils import QUtilities
+from django_tenant_schemas_q.brokers import FairRedis
+from django_tenant_schemas_q.custom import save_fanout
+from django_tenant_schemas_q.models import ScheduleIndex
+from django_tenant_schemas_q.metrics import Metrics, metrics, serve, func_label
+from django_tenant_schemas_q.status import StatusPublisher, get_all
+from django_tenant_schemas_q.workers import WorkerTable, BUSY, RECYCLED
+from django_tenant_schemas_q import codec, blobs
+
+
+# A finished task as the monitor needs it to save it, or a package the worker couldn't decode when id is None
+Record = namedtuple("Record", "id name func schema_name group ack_id row shm")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
 
 
 class MultiTenantCluster(object):
@@ -50,6 +86,7 @@ class MultiTenantCluster(object):
         self.broker = broker or get_broker()
         self.sentinel = None
         self.stop_event = None
+        self.wakeup = None
         self.start_event = None
         self.pid = current_process().pid
         self.cluster_id = uuid.uuid4()
@@ -67,6 +104,8 @@ class MultiTenantCluster(object):
 
         self.stop_event = Event()
         self.start_event = Event()
+        # wakes the sentinel up when the cluster has to stop
+        wakeup, self.wakeup = Pipe(duplex=False)
         self.sentinel = Process(
             target=Sentinel,
             args=(
@@ -76,6 +115,7 @@ class MultiTenantCluster(object):
                 self.broker,
                 self.timeout,
             ),
+            kwargs={"wakeup": wakeup},
         )
         self.sentinel.start()
         logger.info(_(f"Q Cluster {self.name} starting."))
@@ -88,6 +128,10 @@ class MultiTenantCluster(object):
             return False
         logger.info(_(f"Q Cluster {self.name} stopping."))
         self.stop_event.set()
+        try:
+            self.wakeup.send_bytes(b"\0")
+        except OSError:
+            pass
         self.sentinel.join()
         logger.info(_(f"Q Cluster {self.name} has stopped."))
         self.start_event = None
@@ -143,10 +187,13 @@ class Sentinel(object):
         broker=None,
         timeout=Conf.TIMEOUT,
         start=True,
+        wakeup=None,
     ):
         # Make sure we catch signals for the pool
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # the queues and values the workers get have to be created in the context they're started with
+        self.template = use_template()
         self.pid = current_process().pid
         self.cluster_id = cluster_id
         self.parent_pid = get_ppid()
@@ -156,21 +203,49 @@ class Sentinel(object):
         self.tob = timezone.now()
         self.stop_event = stop_event
         self.start_event = start_event
+        # readable when the cluster asks us to stop
+        self.wakeup = wakeup
+        # readable when a worker starts a task with a deadline before the end of the guard cycle
+        self.deadlines, self.deadlines_out = Pipe(duplex=False)
         self.pool_size = Conf.WORKERS
+        # the number of tasks a worker runs at the same time
+        self.slots = max(TenantConf.WORKER_SLOTS, 1) if TenantConf.WORKER_TYPE in ("thread", "asyncio") else 1
         self.pool = []
         self.timeout = timeout
         self.task_queue = (
             Queue(maxsize=Conf.QUEUE_LIMIT) if Conf.QUEUE_LIMIT else Queue()
         )
+        # with schema affinity every worker gets its own queue
+        self.worker_queues = []
+        if TenantConf.AFFINITY:
+            limit = max(Conf.QUEUE_LIMIT // self.pool_size, 1) if Conf.QUEUE_LIMIT else 0
+            self.worker_queues = [
+                Queue(maxsize=limit) if limit else Queue() for __ in range(self.pool_size)
+            ]
         self.result_queue = Queue()
+        self.prefetch = Prefetch(self.pool_size * self.slots)
+        # what every slot of every worker is doing
+        self.table = WorkerTable(self.pool_size * self.slots)
+        # the cluster processes flush their stage metrics to the sentinel
+        self.metrics_queue = Queue() if TenantConf.METRICS_PORT else None
+        self.metrics = Metrics()
+        self.metrics_server = None
+        # publishes the status only when it changes
+        self.publisher = StatusPublisher(self)
         self.event_out = Event()
         self.monitor = None
-        self.pusher = None
+        self.pushers = []
+        self.scheduler = None
         if start:
             self.start()
 
     def start(self):
         self.broker.ping()
+        if isinstance(self.broker, FairRedis):
+            self.broker.publish_weights()
+        if self.metrics_queue:
+            self.metrics.watch(self.table)
+            self.metrics_server = serve(self.metrics)
         self.spawn_cluster()
         self.guard()
 
@@ -178,38 +253,99 @@ class Sentinel(object):
         if not self.start_event.is_set() and not self.stop_event.is_set():
             return Conf.STARTING
         elif self.start_event.is_set() and not self.stop_event.is_set():
-            if self.result_queue.empty() and self.task_queue.empty():
+            if (
+                self.result_queue.empty()
+                and self.task_queue.empty()
+                and all(q.empty() for q in self.worker_queues)
+            ):
                 return Conf.IDLE
             return Conf.WORKING
         elif self.stop_event.is_set() and self.start_event.is_set():
-            if self.monitor.is_alive() or self.pusher.is_alive() or len(self.pool) > 0:
+            if (
+                self.monitor.is_alive()
+                or any(p.is_alive() for p in self.pushers)
+                or (self.scheduler and self.scheduler.is_alive())
+                or len(self.pool) > 0
+            ):
                 return Conf.STOPPING
             return Conf.STOPPED
 
+    @property
+    def pusher(self):
+        # the first pusher, as reported in the status
+        return self.pushers[0] if self.pushers else None
+
     def spawn_process(self, target, *args):
         """
         :type target: function or class
         """
-        p = Process(target=target, args=args)
-        p.daemon = True
-        if target == worker:
+        if target not in (worker, thread_worker, async_worker):
+            # with a template only the workers are forked by it, the others still get the broker connection
+            p = multiprocessing.get_context("fork").Process(target=target, args=args) if self.template else \
+                Process(target=target, args=args)
+            p.daemon = True
+        else:
+            p = Process(target=templated, args=(target,) + args) if self.template else Process(target=target, args=args)
             p.daemon = Conf.DAEMONIZE_WORKERS
-            p.timer = args[2]
+            # the worker reports how long it took to get ready
+            p.spawned = time()
+            p.reincarnated = self.start_event.is_set()
+            # a timer per slot
+            p.timers = args[2] if isinstance(args[2], list) else [args[2]]
+            p.timer = p.timers[0]
             self.pool.append(p)
         p.start()
         return p
 
     def spawn_pusher(self):
-        return self.spawn_process(pusher, self.task_queue, self.event_out, self.broker)
-
-    def spawn_worker(self):
-        self.spawn_process(
-            worker, self.task_queue, self.result_queue, Value(
-                "f", -1), self.timeout
+        return self.spawn_process(
+            pusher,
+            self.task_queue,
+            self.event_out,
+            self.broker,
+            self.worker_queues,
+            self.metrics_queue,
+            self.prefetch,
         )
 
+    def spawn_worker(self, slot=0):
+        """
+        :param int slot: the position of the worker in the pool, which picks its queue with schema affinity
+        """
+        task_queue = self.task_queue
+        steal_queues = None
+        if self.worker_queues:
+            task_queue = self.worker_queues[slot]
+            steal_queues = self.worker_queues[slot + 1:] + self.worker_queues[:slot]
+        timers = self.table.timers(slot * self.slots, self.slots)
+        for timer in timers:
+            timer.reset()
+        if TenantConf.WORKER_TYPE in ("thread", "asyncio"):
+            target = thread_worker if TenantConf.WORKER_TYPE == "thread" else async_worker
+        else:
+            target = worker
+            timers = timers[0]
+        args = [
+            task_queue,
+            self.result_queue,
+            timers,
+            self.timeout,
+            steal_queues,
+            self.metrics_queue,
+            self.prefetch,
+            self.deadlines_out,
+        ]
+        if target is worker:
+            # the process runs nothing but its tasks, they can have its SIGALRM
+            args.append(True)
+        p = self.spawn_process(target, *args)
+        p.slot = slot
+
     def spawn_monitor(self):
-        return self.spawn_process(monitor, self.result_queue, self.broker)
+        return self.spawn_process(monitor, self.result_queue, self.broker, self.metrics_queue)
+
+    def spawn_scheduler(self):
+        return self.spawn_process(schedule_runner, self.event_out, self.cluster_id, self.broker)
 
     def reincarnate(self, process):
         """
@@ -221,19 +357,32 @@ class Sentinel(object):
             self.monitor = self.spawn_monitor()
             logger.error(
                 _(f"reincarnated monitor {process.name} after sudden death"))
-        elif process == self.pusher:
-            self.pusher = self.spawn_pusher()
+        elif process in self.pushers:
+            self.pushers[self.pushers.index(process)] = self.spawn_pusher()
             logger.error(
                 _(f"reincarnated pusher {process.name} after sudden death"))
+        elif process == self.scheduler:
+            self.scheduler = self.spawn_scheduler()
+            logger.error(
+                _(f"reincarnated scheduler {process.name} after sudden death"))
         else:
             self.pool.remove(process)
-            self.spawn_worker()
-            if process.timer.value == 0:
+            now = monotonic()
+            states = [timer.state for timer in process.timers]
+            timed_out = any(timer.expired(now) for timer in process.timers)
+            for state in states:
+                if state == BUSY:
+                    # it died during a task
+                    self.prefetch.finished()
+            if timed_out:
                 # only need to terminate on timeout, otherwise we risk destabilizing the queues
                 process.terminate()
+            # reuses the rows of the process
+            self.spawn_worker(process.slot)
+            if timed_out:
                 logger.warn(
                     _(f"reincarnated worker {process.name} after timeout"))
-            elif int(process.timer.value) == -2:
+            elif RECYCLED in states:
                 logger.info(_(f"recycled worker {process.name}"))
             else:
                 logger.error(
@@ -243,14 +392,16 @@ class Sentinel(object):
 
     def spawn_cluster(self):
         self.pool = []
-        Stat(self).save()
+        self.publisher.publish(force=True)
         close_old_django_connections()
         # spawn worker pool
-        for __ in range(self.pool_size):
-            self.spawn_worker()
+        for slot in range(self.pool_size):
+            self.spawn_worker(slot)
         # spawn auxiliary
         self.monitor = self.spawn_monitor()
-        self.pusher = self.spawn_pusher()
+        self.pushers = [self.spawn_pusher() for __ in range(max(TenantConf.PUSHERS, 1))]
+        if Conf.SCHEDULER:
+            self.scheduler = self.spawn_scheduler()
         # set worker cpu affinity if needed
         if psutil and Conf.CPU_AFFINITY:
             set_cpu_affinity(Conf.CPU_AFFINITY, [w.pid for w in self.pool])
@@ -262,92 +413,198 @@ class Sentinel(object):
             )
         )
         self.start_event.set()
-        Stat(self).save()
+        self.publisher.publish(force=True)
         logger.info(_(f"Q Cluster {humanize(self.cluster_id.hex)} running."))
         counter = 0
-        cycle = Conf.GUARD_CYCLE  # guard loop sleep in seconds
+        cycle = Conf.GUARD_CYCLE  # longest wait between two checks in seconds
         # Guard loop. Runs at least once
         while not self.stop_event.is_set() or not counter:
             # Check Workers
-            for p in self.pool:
-                with p.timer.get_lock():
-                    # Are you alive?
-                    if not p.is_alive() or p.timer.value == 0:
-                        self.reincarnate(p)
-                        continue
-                    # Decrement timer if work is being done
-                    if p.timer.value > 0:
-                        p.timer.value -= cycle
+            for p in list(self.pool):
+                # Are you alive? Or past the deadline of a task?
+                now = monotonic()
+                if not p.is_alive() or any(timer.expired(now) for timer in p.timers):
+                    self.reincarnate(p)
             # Check Monitor
             if not self.monitor.is_alive():
                 self.reincarnate(self.monitor)
-            # Check Pusher
-            if not self.pusher.is_alive():
-                self.reincarnate(self.pusher)
-            # Call scheduler once a minute (or so)
-            counter += cycle
-            if counter >= 30 and Conf.SCHEDULER:
-                counter = 0
-                scheduler(broker=self.broker)
-            # Save current status
-            Stat(self).save()
-            sleep(cycle)
+            # Check Pushers
+            for p in self.pushers:
+                if not p.is_alive():
+                    self.reincarnate(p)
+            # Check Scheduler
+            if self.scheduler and not self.scheduler.is_alive():
+                self.reincarnate(self.scheduler)
+            # Collect the metrics
+            if self.metrics_queue:
+                self.metrics.collect(self.metrics_queue)
+            counter += 1
+            # Publish the status when it changed
+            self.publisher.publish()
+            self.wait(cycle)
         self.stop()
 
+    def wait(self, cycle):
+        """
+        Sleeps until a process dies, the first task deadline passes, the cluster asks us to stop
+        or the cycle is over, whichever comes first
+        """
+        timeout = cycle
+        now = monotonic()
+        for p in self.pool:
+            for timer in p.timers:
+                if timer.state == BUSY and timer.deadline > 0:
+                    timeout = min(timeout, max(timer.deadline - now, 0))
+        processes = self.pool + self.pushers + [self.monitor, self.scheduler]
+        handles = [p.sentinel for p in processes if p] + [self.deadlines]
+        if self.wakeup:
+            handles.append(self.wakeup)
+        ready = multiprocessing.connection.wait(handles, timeout)
+        if self.deadlines in ready:
+            while self.deadlines.poll():
+                self.deadlines.recv_bytes()
+        if self.wakeup in ready:
+            try:
+                while self.wakeup.poll():
+                    self.wakeup.recv_bytes()
+            except (OSError, EOFError):
+                # the cluster is gone, the stop event tells the rest
+                self.wakeup = None
+
     def stop(self):
-        Stat(self).save()
+        self.publisher.publish(force=True)
         name = current_process().name
         logger.info(_(f"{name} stopping cluster processes"))
-        # Stopping pusher
+        # running tasks get until the drain deadline, the ones waiting in the queues go back to the broker
+        drain_until = monotonic() + TenantConf.DRAIN_TIMEOUT if TenantConf.DRAIN_TIMEOUT else None
+        # Stopping pushers
         self.event_out.set()
-        # Wait for it to stop
-        while self.pusher.is_alive():
-            sleep(0.1)
-            Stat(self).save()
-        # Put poison pills in the queue
-        for __ in range(len(self.pool)):
-            self.task_queue.put("STOP")
-        self.task_queue.close()
-        # wait for the task queue to empty
-        self.task_queue.join_thread()
+        # Wait for them and the scheduler to stop
+        self.join(self.pushers + [self.scheduler])
+        if drain_until:
+            self.requeue_prefetched()
+        # Put poison pills in the queue, one for every slot of a worker
+        for p in self.pool:
+            task_queue = self.worker_queues[p.slot] if self.worker_queues else self.task_queue
+            for __ in p.timers:
+                task_queue.put("STOP")
+        for task_queue in [self.task_queue] + self.worker_queues:
+            task_queue.close()
+            # wait for the task queue to empty
+            task_queue.join_thread()
         # Wait for all the workers to exit
-        while len(self.pool):
-            for p in self.pool:
-                if not p.is_alive():
-                    self.pool.remove(p)
-            sleep(0.1)
-            Stat(self).save()
+        self.join(self.pool, drain_until)
+        abandoned = [p for p in self.pool if p.is_alive()]
+        for p in abandoned:
+            self.abandon(p)
+        self.pool = []
         # Finally stop the monitor
         self.result_queue.put("STOP")
         self.result_queue.close()
-        # Wait for the result queue to empty
-        self.result_queue.join_thread()
+        if abandoned:
+            # a killed worker can leave the queue locked or half a result in it, nothing may wait on it
+            self.result_queue.cancel_join_thread()
+        else:
+            # Wait for the result queue to empty
+            self.result_queue.join_thread()
         logger.info(_(f"{name} waiting for the monitor."))
         # Wait for everything to close or time out
-        count = 0
         if not self.timeout:
             self.timeout = 30
-        while self.status() == Conf.STOPPING and count < self.timeout * 10:
-            sleep(0.1)
-            Stat(self).save()
-            count += 1
+        self.join([self.monitor], monotonic() + self.timeout)
+        if abandoned and self.monitor and self.monitor.is_alive():
+            logger.error(_(f"{name} killed the monitor {self.monitor.name}, it was stuck on the result queue"))
+            self.monitor.terminate()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
         # Final status
-        Stat(self).save()
+        self.publisher.publish(force=True)
+
+    def join(self, processes, deadline=None):
+        """
+        Waits for processes to exit, publishing the status in between
+        :param deadline: the monotonic time to stop waiting at
+        """
+        processes = [p for p in processes if p]
+        while True:
+            alive = [p for p in processes if p.is_alive()]
+            timeout = Conf.GUARD_CYCLE
+            if deadline:
+                timeout = min(timeout, deadline - monotonic())
+            if not alive or timeout <= 0:
+                return
+            multiprocessing.connection.wait([p.sentinel for p in alive], timeout)
+            self.publisher.publish()
+
+    def requeue_prefetched(self):
+        """
+        Returns the tasks the pushers queued for the workers, but no worker started, to the broker
+        """
+        tasks = []
+        for task_queue in [self.task_queue] + self.worker_queues:
+            while True:
+                try:
+                    task = task_queue.get(timeout=0.05)
+                except Empty:
+                    break
+                if task != "STOP":
+                    tasks.append(task)
+        if not tasks:
+            return
+        try:
+            count = requeue(self.broker, tasks)
+        except Exception as e:
+            logger.error(e)
+            return
+        logger.info(_(f"{current_process().name} returned {count} prefetched tasks to the broker"))
+
+    def abandon(self, process):
+        """
+        Kills a worker still running a task at the drain deadline and fails its tasks through the broker,
+        which releases their lease. They aren't requeued, they may have done part of their work.
+        """
+        process.terminate()
+        process.join(Conf.GUARD_CYCLE)
+        for timer in process.timers:
+            row = timer.snapshot()
+            if row["state"] != "busy":
+                continue
+            logger.error(
+                _(f"{process.name} killed at the drain deadline while running task {row['task_id']} "
+                  f"of {row['schema_name']}"))
+            if timer.ack_id:
+                try:
+                    self.broker.fail(timer.ack_id)
+                except Exception as e:
+                    logger.error(e)
 
 
-def pusher(task_queue, event, broker=None):
+def pusher(task_queue, event, broker=None, worker_queues=None, metrics_queue=None, prefetch=None):
     """
     Pulls tasks of the broker and puts them in the task queue
     :type task_queue: multiprocessing.Queue
     :type event: multiprocessing.Event
+    :param worker_queues: the queues of the workers when dispatching with schema affinity
+    :param metrics_queue: the queue to flush the stage metrics to
+    :param prefetch: sizes the number of tasks waiting for the workers
+    :type prefetch: Prefetch
     """
     if not broker:
         broker = get_broker()
+    if metrics_queue:
+        metrics.bind(metrics_queue)
     logger.info(
         _(f"{current_process().name} pushing tasks at {current_process().pid}"))
+    queues = worker_queues or [task_queue]
     while True:
+        # don't take more tasks than the workers get through in time
+        while prefetch and not event.is_set() and prefetch.queued(queues) >= prefetch.depth():
+            prefetch.wait(0.1)
         try:
+            start = perf_counter()
             task_set = broker.dequeue()
+            if task_set:
+                metrics.observe("dequeue", perf_counter() - start)
         except Exception as e:
             logger.error(e, traceback.format_exc())
             # broker probably crashed. Let the sentinel handle it.
@@ -356,191 +613,1208 @@ def pusher(task_queue, event, broker=None):
         if task_set:
             for task in task_set:
                 ack_id = task[0]
+                if TenantConf.COMPACT_TRANSPORT and not worker_queues:
+                    # the worker decodes it
+                    task_queue.put((ack_id, task[1], time() if metrics.enabled else 0))
+                    continue
                 # unpack the task
                 try:
-                    task = SignedPackage.loads(task[1])
+                    start = perf_counter()
+                    task = codec.loads(task[1])
                 except (TypeError, BadSignature) as e:
                     logger.error(e, traceback.format_exc())
                     broker.fail(ack_id)
                     continue
+                if metrics.enabled:
+                    metrics.observe("loads", perf_counter() - start, schema_of(task), task["func"])
+                    task["pushed"] = time()
                 task["ack_id"] = ack_id
-                task_queue.put(task)
+                dispatch(task, task_queue, worker_queues)
             logger.debug(_(f"queueing from {broker.list_key}"))
         if event.is_set():
             break
     logger.info(_(f"{current_process().name} stopped pushing tasks"))
 
 
-def worker(task_queue, result_queue, timer, timeout=Conf.TIMEOUT):
+def dispatch(task, task_queue, worker_queues=None):
+    """
+    Puts a task in the task queue or, with schema affinity, in the queue of the worker owning its schema.
+    Only when that queue is full the task goes to the first other worker with room.
+    """
+    if not worker_queues:
+        task_queue.put(task)
+        return
+    schema_name = schema_of(task)
+    slot = zlib.crc32(schema_name.encode()) % len(worker_queues)
+    for q in worker_queues[slot:] + worker_queues[:slot]:
+        try:
+            q.put_nowait(task)
+            return
+        except Full:
+            continue
+    worker_queues[slot].put(task)
+
+
+class Prefetch(object):
+    """
+    Counts the busy workers and keeps an average of the task execution time,
+    shared between the workers and the pushers
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.busy = Value("i", 0)
+        self.runtime = Value("d", 0.0)
+        # set whenever a worker frees up a slot
+        self.released = Event()
+
+    def started(self):
+        with self.busy.get_lock():
+            self.busy.value += 1
+
+    def finished(self, seconds=None):
+        with self.busy.get_lock():
+            self.busy.value = max(self.busy.value - 1, 0)
+        if seconds is not None:
+            with self.runtime.get_lock():
+                if self.runtime.value:
+                    self.runtime.value = self.runtime.value * 0.9 + seconds * 0.1
+                else:
+                    self.runtime.value = seconds
+        self.released.set()
+
+    def wait(self, timeout):
+        """
+        Blocks until a worker frees up a slot or timeout seconds have passed
+        """
+        self.released.wait(timeout)
+        self.released.clear()
+
+    def depth(self):
+        """
+        The number of tasks to keep waiting: one for every idle worker and
+        PREFETCH_WINDOW seconds of work per worker, never more than QUEUE_LIMIT
+        """
+        idle = max(self.workers - self.busy.value, 0)
+        window = min(TenantConf.PREFETCH_WINDOW, Conf.RETRY / 2) if Conf.RETRY else TenantConf.PREFETCH_WINDOW
+        runtime = self.runtime.value
+        depth = idle + (int(self.workers * window / runtime) if runtime else self.workers)
+        if Conf.QUEUE_LIMIT:
+            depth = min(depth, Conf.QUEUE_LIMIT)
+        return max(depth, 1)
+
+    @staticmethod
+    def queued(queues):
+        try:
+            return sum(q.qsize() for q in queues)
+        except NotImplementedError:
+            # no qsize on macOS, rely on QUEUE_LIMIT
+            return 0
+
+
+def requeue(broker, tasks):
+    """
+    Puts tasks taken from the task queue back at the front of the broker queue, releasing their broker lease
+    :param tasks: tasks as the pushers queue them, decoded or as compact tuples
+    :return: the number of tasks returned
+    """
+    packages = []
+    for task in tasks:
+        if isinstance(task, tuple):
+            ack_id, package = task[0], task[1]
+            schema_name = schema_of(codec.loads(package)) if isinstance(broker, FairRedis) else ""
+        else:
+            ack_id = task.pop("ack_id", None)
+            task.pop("pushed", None)
+            schema_name = schema_of(task)
+            package = codec.dumps(task)
+        packages.append((ack_id, package, schema_name))
+    if isinstance(broker, FairRedis):
+        broker.requeue(packages)
+    elif isinstance(broker, Redis):
+        # the pushers pop from the left, so the first task has to go in last
+        pipe = broker.connection.pipeline(transaction=False)
+        for __, package, __ in reversed(packages):
+            pipe.lpush(broker.list_key, package)
+        pipe.execute()
+    else:
+        for ack_id, package, __ in packages:
+            broker.enqueue(package)
+            if ack_id:
+                broker.acknowledge(ack_id)
+    return len(packages)
+
+
+def schema_of(task):
+    return task.get("kwargs", {}).get("schema_name") or ""
+
+
+def affinity_tasks(task_queue, steal_queues, slots=None):
+    """
+    Yields the tasks of a worker's own queue until it receives a STOP.
+    While its own queue is empty the worker steals tasks from the queues of the others.
+    :param slots: stops yielding once the worker is recycled
+    """
+    while not (slots and slots.recycled):
+        try:
+            task = task_queue.get(timeout=TenantConf.STEAL_WAIT)
+        except Empty:
+            task = steal(steal_queues)
+            if task is None:
+                continue
+        if task == "STOP":
+            return
+        yield task
+
+
+def steal(steal_queues):
+    """
+    Takes a task from the first of the other workers' queues that has one
+    """
+    for q in steal_queues:
+        try:
+            task = q.get_nowait()
+        except Empty:
+            continue
+        if task == "STOP":
+            # not ours, give it back
+            q.put(task)
+            continue
+        return task
+
+
+def worker(
+    task_queue, result_queue, timer, timeout=Conf.TIMEOUT, steal_queues=None, metrics_queue=None, prefetch=None,
+    deadlines=None, soft_timeouts=False,
+):
     """
     Takes a task from the task queue, tries to execute it and puts the result back in the result queue
     :type task_queue: multiprocessing.Queue
     :type result_queue: multiprocessing.Queue
-    :type timer: multiprocessing.Value
+    :param timer: the row of the worker in the worker table
+    :type timer: django_tenant_schemas_q.workers.Timer
+    :param steal_queues: the queues of the other workers when dispatching with schema affinity
+    :param metrics_queue: the queue to flush the stage metrics to
+    :param prefetch: tells the pushers how busy the workers are
+    :type prefetch: Prefetch
+    :param deadlines: the connection waking the sentinel up for deadlines shorter than a guard cycle
+    :param soft_timeouts: raise SoftTimeout in tasks with SIGALRM, only for the process workers of a cluster
     """
 
     name = current_process().name
-    logger.info(_(f"{name} ready for work at {current_process().pid}"))
-    task_count = 0
+    if metrics_queue:
+        metrics.bind(metrics_queue)
+    seconds = ready()
+    logger.info(_(f"{name} ready for work at {current_process().pid} in {seconds * 1000:.0f}ms"))
+    slots = Slots(deadlines, soft_timeouts)
+    timer.reset(current_process().pid)
     if timeout is None:
         timeout = -1
 
     try:
         # Start reading the task queue
 
-        for task in iter(task_queue.get, "STOP"):
-            result = None
-            timer.value = -1  # Idle
-            task_count += 1
-            # Get the function from the task
-            logger.info(_(f'{name} processing [{task["name"]}]'))
-            f = task["func"]
-            # if it's not an instance try to get it from the string
-            if not callable(task["func"]):
+        tasks = affinity_tasks(task_queue, steal_queues) if steal_queues else iter(task_queue.get, "STOP")
+        for task in tasks:
+            try:
+                if not execute(task, result_queue, timer, timeout, prefetch, slots):
+                    break
+            except Exception:
+                broken(task, result_queue, timer, prefetch)
+        slots.finish(name)
+    except Exception:
+        logger.exception(_(f"{name} stopped on an error"))
+
+
+def thread_worker(
+    task_queue, result_queue, timers, timeout=Conf.TIMEOUT, steal_queues=None, metrics_queue=None, prefetch=None,
+    deadlines=None,
+):
+    """
+    A worker running a thread per timer, each taking tasks from the task queue with its own database connection.
+    For tasks that mostly wait on I/O.
+    :param timers: the row of every slot in the worker table
+    """
+    name = current_process().name
+    if metrics_queue:
+        metrics.bind(metrics_queue)
+    seconds = ready()
+    logger.info(_(
+        f"{name} ready for work with {len(timers)} threads at {current_process().pid} in {seconds * 1000:.0f}ms"))
+    slots = Slots(deadlines)
+    for timer in timers:
+        timer.reset(current_process().pid)
+    if timeout is None:
+        timeout = -1
+
+    def run_slot(timer):
+        connect()
+        try:
+            for task in slot_tasks(task_queue, steal_queues, slots):
                 try:
-                    module, func = f.rsplit(".", 1)
-                    m = importlib.import_module(module)
-                    f = getattr(m, func)
-                except (ValueError, ImportError, AttributeError) as e:
-                    result = (e, False)
-                    if error_reporter:
-                        error_reporter.report()
-            # We're still going
-            if not result:
-                close_old_django_connections()
-                timer_value = task.pop("timeout", timeout)
-                # signal execution
-                pre_execute.send(sender="django_q", func=f, task=task)
-                # execute the payload
-                timer.value = timer_value  # Busy
+                    if not execute(task, result_queue, timer, timeout, prefetch, slots):
+                        break
+                except Exception:
+                    broken(task, result_queue, timer, prefetch)
+        except Exception:
+            logger.exception(_(f"{name} slot {timer.index} stopped on an error"))
+        finally:
+            db.connection.close()
+
+    threads = [threading.Thread(target=run_slot, args=(timer,), daemon=True) for timer in timers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    slots.finish(name, timers)
+
+
+def async_worker(
+    task_queue, result_queue, timers, timeout=Conf.TIMEOUT, steal_queues=None, metrics_queue=None, prefetch=None,
+    deadlines=None,
+):
+    """
+    A worker running an asyncio loop with a slot per timer. Coroutine functions are awaited on the loop,
+    other functions run in a thread. For tasks that mostly wait on I/O.
+    :param timers: the row of every slot in the worker table
+    """
+    name = current_process().name
+    if metrics_queue:
+        metrics.bind(metrics_queue)
+    seconds = ready()
+    logger.info(_(
+        f"{name} ready for work with {len(timers)} slots at {current_process().pid} in {seconds * 1000:.0f}ms"))
+    slots = Slots(deadlines)
+    for timer in timers:
+        timer.reset(current_process().pid)
+    if timeout is None:
+        timeout = -1
+    # the slots wait for their tasks in these threads, the loop never blocks on the task queue
+    getters = ThreadPoolExecutor(max_workers=len(timers))
+
+    async def run_slot(timer):
+        loop = asyncio.get_running_loop()
+        tasks = slot_tasks(task_queue, steal_queues, slots)
+        try:
+            while True:
+                task = await loop.run_in_executor(getters, next, tasks, None)
+                if task is None:
+                    break
                 try:
+                    if not await aexecute(task, result_queue, timer, timeout, prefetch, slots):
+                        break
+                except Exception:
+                    broken(task, result_queue, timer, prefetch)
+        except Exception:
+            logger.exception(_(f"{name} slot {timer.index} stopped on an error"))
 
-                    # Checking for the presence of kwargs
-                    args_state = getfullargspec(f)
+    async def run_slots():
+        await asyncio.gather(*(run_slot(timer) for timer in timers))
 
-                    kwargs = task.get('kwargs', {})
-                    schema_name = kwargs.get('schema_name', None)
-                    if schema_name:
+    asyncio.run(run_slots())
+    getters.shutdown()
+    slots.finish(name, timers)
 
-                        with schema_context(schema_name):
 
-                            if args_state.varkw:
-                                res = f(*task["args"], **task["kwargs"])
-                            else:
-                                res = f(*task["args"])
-                            result = (res, True)
-                    else:
-                        result = (None, False)
+class Slots(object):
+    """
+    Counts the tasks of a worker process over its slots, tells them when to recycle
+    and wakes the sentinel up for their short deadlines
+    """
 
-                except Exception as e:
-                    result = (f"{e} : {traceback.format_exc()}", False)
-                    if error_reporter:
-                        error_reporter.report()
-            with timer.get_lock():
-                # Process result
-                task["result"] = result[0]
-                task["success"] = result[1]
-                task["stopped"] = timezone.now()
-                result_queue.put(task)
-                timer.value = -1  # Idle
-                # Recycle
-                if task_count == Conf.RECYCLE:
-                    timer.value = -2  # Recycled
-                    break
-        logger.info(_(f"{name} stopped doing work"))
+    def __init__(self, deadlines=None, soft_timeouts=False):
+        self.lock = threading.Lock()
+        self.deadlines = deadlines
+        # whether the tasks may get a SoftTimeout
+        self.soft_timeouts = soft_timeouts
+        if deadlines:
+            # a full pipe already wakes the sentinel up, the workers never wait for it
+            os.set_blocking(deadlines.fileno(), False)
+        self.count = 0
+        self.resolve_time = 0
+        self.recycled = False
+        # the resident memory after the last task, when measured
+        self.rss = 0
+        # bytes the tasks grew the worker by per schema and function, when measured
+        self.growth = {}
+
+    def add(self):
+        with self.lock:
+            self.count += 1
+
+    def grew(self, growth, schema_name, func):
+        metrics.observe("memory_growth", growth, schema_name, func)
+        key = (schema_name, func_label(func))
+        with self.lock:
+            self.growth[key] = self.growth.get(key, 0) + growth
+
+    def wake(self, timeout, grace=0):
+        """
+        Wakes the sentinel up when a task has a timeout shorter than a guard cycle, it would sleep through it otherwise
+        :param grace: seconds the sentinel gives the task on top of its timeout
+        """
+        if not self.deadlines or not timeout or timeout <= 0 or timeout + grace >= Conf.GUARD_CYCLE:
+            return
+        try:
+            with self.lock:
+                self.deadlines.send_bytes(b"\0")
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            logger.error(e)
+
+    def done(self, rss=0):
+        """
+        Whether the worker has done its share of tasks or outgrew MAX_MEMORY and has to be recycled
+        :param rss: the resident memory of the worker in bytes, 0 when it isn't measured
+        """
+        with self.lock:
+            if rss:
+                self.rss = rss
+            if self.count >= Conf.RECYCLE or (TenantConf.MAX_MEMORY and rss >= TenantConf.MAX_MEMORY * 1024 * 1024):
+                self.recycled = True
+            return self.recycled
+
+    def finish(self, name, timers=()):
+        if self.recycled:
+            for timer in timers:
+                timer.recycle()
+        metrics.flush()
+        if self.count:
+            logger.debug(
+                _(f"{name} resolved {self.count} functions in {self.resolve_time * 1000:.2f}ms "
+                  f"{resolve_func.cache_info()}"))
+        (schema_name, func), growth = max(self.growth.items(), key=lambda item: item[1], default=(("", ""), 0))
+        if self.rss and growth >= 1024 * 1024:
+            logger.info(_(f"{name} stopped doing work at {self.rss / 1024 / 1024:.0f}MB, "
+                          f"{func} grew it the most in {schema_name} by {growth / 1024 / 1024:.0f}MB"))
+        elif self.rss:
+            logger.info(_(f"{name} stopped doing work at {self.rss / 1024 / 1024:.0f}MB"))
+        else:
+            logger.info(_(f"{name} stopped doing work"))
+
+
+def slot_tasks(task_queue, steal_queues, slots):
+    """
+    Yields the tasks of one slot of a worker until it receives a STOP or the worker is recycled.
+    The queue is read with a timeout so no slot is left holding its lock when the worker exits.
+    """
+    tasks = affinity_tasks(task_queue, steal_queues, slots) if steal_queues else None
+    while not slots.recycled:
+        if tasks:
+            task = next(tasks, "STOP")
+        else:
+            try:
+                task = task_queue.get(timeout=1)
+            except Empty:
+                continue
+        if task == "STOP":
+            return
+        if slots.recycled:
+            # another slot finished the worker's share, give it back
+            task_queue.put(task)
+            return
+        yield task
+
+
+def prepare(task, timer, timeout, prefetch, slots, elsewhere=False):
+    """
+    Gets a task ready to run
+    :param elsewhere: the task runs on another thread, which switches its own connection
+    :return: the task, the function, whether it takes keyword arguments and the timeout.
+        The function is None when the task failed already or isn't a task but a bad package record.
+    """
+    timer.idle()
+    if isinstance(task, tuple):
+        task = unpack(task)
+        if isinstance(task, Record):
+            return task, None, False, timeout
+    slots.add()
+    task["task_start"] = perf_counter()
+    if measure_memory():
+        task["task_rss"] = rss()
+    if prefetch:
+        prefetch.started()
+    pushed = task.pop("pushed", None)
+    if pushed:
+        metrics.observe("queue_wait", time() - pushed, schema_of(task), task["func"])
+    # Get the function from the task
+    logger.info(_(f'{current_process().name} processing [{task["name"]}]'))
+    f = task["func"]
+    resolve_start = perf_counter()
+    varkw = False
+    try:
+        # unhashable callables can't be cached
+        f, varkw = resolve_func(f) if isinstance(f, Hashable) else resolve_func.__wrapped__(f)
+    except (ValueError, ImportError, AttributeError, TypeError) as e:
+        task["result"], task["success"] = e, False
+        f = None
+        if error_reporter:
+            error_reporter.report()
+    slots.resolve_time += perf_counter() - resolve_start
+    timer_value = task.pop("timeout", timeout)
+    if f:
+        close_old_django_connections()
+        schema_name = schema_of(task)
+        if schema_name:
+            # the receivers get the schema of this task
+            start = perf_counter()
+            try:
+                switch_schema(schema_name)
+            except Exception as e:
+                task["result"], task["success"] = f"{e} : {traceback.format_exc()}", False
+                return task, None, varkw, timer_value
+            metrics.observe("schema_switch", perf_counter() - start, schema_name, task["func"])
+        # signal execution
+        try:
+            pre_execute.send(sender="django_q", func=f, task=task)
+        finally:
+            if elsewhere:
+                reset_schema()
+    return task, f, varkw, timer_value
+
+
+def call(task, f, varkw, soft_timeout=0):
+    """
+    Runs the function of a task in its schema
+    :param soft_timeout: seconds after which SoftTimeout is raised in the task, 0 never does
+    :return: a tuple of the result and whether it succeeded
+    """
+    try:
+        schema_name = schema_of(task)
+        if not schema_name:
+            return None, False
+        # prepare switched already, unless a pre_execute receiver moved the connection
+        switch_schema(schema_name)
+
+        # large arguments wait in the blob store
+        args, kwargs = blobs.fetch_arguments(task["args"], task["kwargs"])
+        start = perf_counter()
+        try:
+            with alarm(soft_timeout):
+                if varkw:
+                    res = f(*args, **kwargs)
+                else:
+                    res = f(*args)
+        finally:
+            metrics.observe("execute", perf_counter() - start, schema_name, task["func"])
+        return blobs.offload(res, blobs.transient(task)), True
     except Exception as e:
-        print(e)
+        if error_reporter:
+            error_reporter.report()
+        return f"{e} : {traceback.format_exc()}", False
+    finally:
+        reset_schema()
+
+
+class SoftTimeout(Exception):
+    """
+    Raised in a task that runs past its timeout when TIMEOUT_GRACE is set. The task has TIMEOUT_GRACE seconds
+    to clean up before its worker is killed.
+    """
+
+
+def raise_soft_timeout(signum, frame):
+    raise SoftTimeout("Task exceeded its timeout")
+
 
+@contextmanager
+def alarm(seconds):
+    """
+    Raises SoftTimeout in the block after seconds, if they're positive
+    """
+    if not seconds or seconds <= 0:
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, raise_soft_timeout)
+    started = monotonic()
+    delay, interval = signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        if delay:
+            # what is left of a timer that was already running
+            signal.setitimer(signal.ITIMER_REAL, max(delay - (monotonic() - started), 0.001), interval)
+
+
+def soft_timeout(timeout, allowed=False):
+    """
+    The seconds after which a task running on this thread gets a SoftTimeout, 0 if it can't get one.
+    Signals only reach the main thread, so only process workers get them.
+    :param allowed: whether the worker owns SIGALRM. Tasks run synchronously share it with the caller, they don't
+    """
+    if not allowed or not TenantConf.TIMEOUT_GRACE or not timeout or timeout <= 0:
+        return 0
+    if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        return 0
+    return timeout
+
+
+def deadline(timeout, grace=0):
+    """
+    The monotonic time a task has to be done by before the sentinel kills its worker
+    :return: the deadline, -1 without a timeout
+    """
+    if not timeout or timeout <= 0:
+        return -1
+    return monotonic() + timeout + grace
 
-def monitor(result_queue, broker=None):
+
+async def acall(task, f, varkw, timeout):
+    """
+    Awaits a coroutine function in the schema of its task, cancelling it after timeout seconds
+    :return: a tuple of the result and whether it succeeded
+    """
+    try:
+        schema_name = schema_of(task)
+        if not schema_name:
+            return None, False
+        # the coroutine reaches the database through QUtilities.tenant_sync_to_async
+        QUtilities.current_schema.set(schema_name)
+        args, kwargs = await sync_to_async(blobs.fetch_arguments, thread_sensitive=False)(task["args"], task["kwargs"])
+        coroutine = f(*args, **kwargs) if varkw else f(*args)
+        start = perf_counter()
+        try:
+            res = await asyncio.wait_for(coroutine, timeout) if timeout and timeout > 0 else await coroutine
+        finally:
+            metrics.observe("execute", perf_counter() - start, schema_name, task["func"])
+        return await sync_to_async(blobs.offload, thread_sensitive=False)(res, blobs.transient(task)), True
+    except asyncio.TimeoutError:
+        return f"Timed out after {timeout} seconds", False
+    except Exception as e:
+        if error_reporter:
+            error_reporter.report()
+        return f"{e} : {traceback.format_exc()}", False
+
+
+def finish(task, result, result_queue, timer, prefetch, slots):
+    """
+    Sends a finished task to the monitor
+    :return: whether the slot can take another task
+    """
+    # Process result
+    task["result"] = result[0]
+    task["success"] = result[1]
+    task["stopped"] = timezone.now()
+    task_start = task.pop("task_start")
+    task_rss = task.pop("task_rss", None)
+    result_queue.put(compact(task) if TenantConf.COMPACT_TRANSPORT else task)
+    timer.idle(processed=True)
+    if prefetch:
+        prefetch.finished(perf_counter() - task_start)
+    memory = 0
+    if task_rss is not None:
+        memory = rss()
+        # what the task left behind, concurrent slots of a worker blur it
+        slots.grew(max(memory - task_rss, 0), schema_of(task), task["func"])
+    # Recycle
+    if slots.done(memory):
+        timer.recycle()
+        return False
+    return True
+
+
+def broken(task, result_queue, timer, prefetch=None):
+    """
+    Reports a task the worker failed to handle as failed, so it doesn't go missing, and frees its slot
+    :param task: the task as the worker got it
+    """
+    logger.exception(_(f"{current_process().name} failed to handle a task"))
+    try:
+        if isinstance(task, tuple):
+            task = unpack(task)
+        if isinstance(task, Record):
+            result_queue.put(task)
+        elif "stopped" not in task:
+            # finish sets stopped right before it reports the task
+            if task.pop("task_start", None) is not None and prefetch:
+                prefetch.finished()
+            task.pop("task_rss", None)
+            task["result"], task["success"] = traceback.format_exc(), False
+            task["stopped"] = timezone.now()
+            result_queue.put(task)
+        timer.idle()
+    except Exception:
+        logger.exception(_(f"{current_process().name} failed to report a broken task"))
+
+
+def execute(task, result_queue, timer, timeout, prefetch, slots):
+    """
+    Runs a task and sends it to the monitor
+    :return: whether the slot can take another task
+    """
+    task, f, varkw, timer_value = prepare(task, timer, timeout, prefetch, slots)
+    if isinstance(task, Record):
+        result_queue.put(task)
+        return True
+    if f:
+        # execute the payload
+        soft = soft_timeout(timer_value, slots.soft_timeouts)
+        timer.busy(task, deadline(timer_value, TenantConf.TIMEOUT_GRACE if soft else 0), schema_of(task), func_label(f))
+        slots.wake(timer_value)
+        result = call(task, f, varkw, soft)
+    else:
+        # prepare failed it already
+        result = (task["result"], task["success"])
+    return finish(task, result, result_queue, timer, prefetch, slots)
+
+
+async def aexecute(task, result_queue, timer, timeout, prefetch, slots):
+    """
+    Runs a task on the loop of an asyncio worker and sends it to the monitor
+    :return: whether the slot can take another task
+    """
+    task, f, varkw, timer_value = await sync_to_async(prepare, thread_sensitive=False)(
+        task, timer, timeout, prefetch, slots, True)
+    if isinstance(task, Record):
+        result_queue.put(task)
+        return True
+    if not f:
+        # prepare failed it already
+        result = (task["result"], task["success"])
+    elif asyncio.iscoroutinefunction(f):
+        # cancelled on the loop before the sentinel would have to kill the worker
+        timer.busy(task, deadline(timer_value, 1), schema_of(task), func_label(f))
+        slots.wake(timer_value, 1)
+        result = await acall(task, f, varkw, timer_value)
+    else:
+        timer.busy(task, deadline(timer_value), schema_of(task), func_label(f))
+        slots.wake(timer_value)
+        result = await sync_to_async(call, thread_sensitive=False)(task, f, varkw)
+    return await sync_to_async(finish, thread_sensitive=False)(task, result, result_queue, timer, prefetch, slots)
+
+
+def unpack(package):
+    """
+    Decodes a package the pusher passed on undecoded
+    :param package: a tuple of the ack id, the signed package and the time it was pushed at
+    :return: the task, or a record without id if the package is bad
+    """
+    ack_id, pack, pushed = package
+    try:
+        start = perf_counter()
+        task = codec.loads(pack)
+    except (TypeError, BadSignature) as e:
+        logger.error(e, traceback.format_exc())
+        return Record(None, None, None, None, None, ack_id, None, None)
+    if pushed:
+        metrics.observe("loads", perf_counter() - start, schema_of(task), task["func"])
+        task["pushed"] = pushed
+    task["ack_id"] = ack_id
+    return task
+
+
+def compact(task):
+    """
+    Turns a saved successful task into a record with its database row prepared here in the worker,
+    so the monitor doesn't have to pickle its arguments and result again.
+    A large result goes through shared memory. Tasks the monitor needs in full are returned as they are.
+    """
+    if (
+        not task["success"]
+        or not task.get("save", Conf.SAVE_LIMIT >= 0)
+        or not schema_of(task)
+        or any(task.get(key) for key in ("cached", "chain", "fanout", "iter_count"))
+    ):
+        return task
+    try:
+        row = task_row(task)
+    except Exception as e:
+        logger.error(e)
+        return task
+    shm = None
+    result = row[RESULT_INDEX]
+    if SharedMemory and TenantConf.COMPACT_SHM_SIZE and result and len(result) > TenantConf.COMPACT_SHM_SIZE:
+        data = result.encode()
+        block = SharedMemory(create=True, size=len(data))
+        block.buf[: len(data)] = data
+        shm = (block.name, len(data))
+        block.close()
+        # the monitor unlinks it
+        resource_tracker.unregister(block._name, "shared_memory")
+        row[RESULT_INDEX] = None
+    func = func_label(task["func"])
+    return Record(task["id"], task["name"], func, schema_of(task), task.get("group"), task.get("ack_id"), row, shm)
+
+
+def expand(record, broker):
+    """
+    Turns a record back into the task package the monitor works with
+    :return: the task, None for a bad package
+    """
+    if record.id is None:
+        if record.ack_id:
+            broker.fail(record.ack_id)
+        return None
+    row = record.row
+    if record.shm:
+        name, size = record.shm
+        block = SharedMemory(name=name)
+        try:
+            row[RESULT_INDEX] = bytes(block.buf[:size]).decode()
+        finally:
+            block.close()
+            block.unlink()
+    return {
+        "id": record.id,
+        "name": record.name,
+        "func": record.func,
+        "kwargs": {"schema_name": record.schema_name},
+        "group": record.group,
+        "ack_id": record.ack_id,
+        "success": True,
+        "row": row,
+    }
+
+
+@lru_cache(maxsize=TenantConf.FUNC_CACHE_SIZE)
+def resolve_func(func):
+    """
+    Gets the function of a task and whether it accepts keyword arguments
+    :param func: the function or its dotted path
+    :return: a tuple of the function and whether to pass it the task kwargs
+    """
+    f = func
+    # if it's not an instance try to get it from the string
+    if not callable(func):
+        module, func = f.rsplit(".", 1)
+        m = importlib.import_module(module)
+        f = getattr(m, func)
+    # Checking for the presence of kwargs
+    return f, bool(getfullargspec(f).varkw)
+
+
+def switch_schema(schema_name):
+    """
+    Points the worker's connection at a schema. With TENANT_LIMIT_SET_CALLS the connection stays there
+    after the task, so consecutive tasks of the same schema don't set the search path again.
+    """
+    if db.connection.schema_name != schema_name:
+        db.connection.set_schema(schema_name)
+
+
+def reset_schema():
+    """
+    Puts the worker's connection back in the public schema after a task, so nothing running between tasks
+    sees the schema of the last one. Unless TENANT_LIMIT_SET_CALLS asks to keep it.
+    Without it tenant_schemas sets the search path for every cursor anyway, so this costs no query.
+    """
+    if not getattr(settings, "TENANT_LIMIT_SET_CALLS", False):
+        db.connection.set_schema_to_public()
+
+
+def preload_modules():
+    """
+    Imports the PRELOAD task modules so the first tasks of a worker don't pay for the imports
+    """
+    for module in TenantConf.PRELOAD:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.error(_(f"{current_process().name} failed to preload {module}: {e}"))
+
+
+def use_template():
+    """
+    Switches this process to starting its processes from the fork server when WORKER_TEMPLATE is set.
+    The fork server imports the template module first, so every worker it forks has Django set up
+    and the PRELOAD modules imported.
+    :return: whether the workers are forked from the template
+    """
+    if not TenantConf.WORKER_TEMPLATE:
+        return False
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        logger.error(_("Worker templates need the forkserver start method, spawning workers as usual"))
+        return False
+    multiprocessing.set_start_method("forkserver", force=True)
+    multiprocessing.set_forkserver_preload(["django_tenant_schemas_q.template"])
+    return True
+
+
+def templated(target, *args):
+    """
+    Runs a worker forked from the template, which doesn't share the signal handling of the sentinel
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(*args)
+
+
+def ready():
+    """
+    Gets a worker ready for its first task and observes how long it took since the sentinel spawned it
+    :return: the seconds it took
+    """
+    preload_modules()
+    if TenantConf.WORKER_TYPE == "process":
+        connect()
+    spawned = getattr(current_process(), "spawned", None)
+    if spawned is None:
+        return 0
+    seconds = time() - spawned
+    metrics.observe("reincarnate" if current_process().reincarnated else "spawn", seconds)
+    return seconds
+
+
+def measure_memory():
+    return bool(TenantConf.MAX_MEMORY) or metrics.enabled
+
+
+def rss():
+    """
+    The resident memory of this process in bytes, 0 if it can't be read
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    if psutil:
+        return psutil.Process().memory_info().rss
+    return 0
+
+
+def connect():
+    """
+    Connects a template worker, or a slot of one, to the database before its first task.
+    Only helps when CONN_MAX_AGE keeps the connection open between tasks.
+    """
+    if not TenantConf.WORKER_TEMPLATE:
+        return
+    try:
+        db.connection.ensure_connection()
+    except Exception as e:
+        logger.error(e)
+
+
+def monitor(result_queue, broker=None, metrics_queue=None):
     """
     Gets finished tasks from the result queue and saves them to Django
     :type result_queue: multiprocessing.Queue
+    :param metrics_queue: the queue to flush the stage metrics to
     """
     if not broker:
         broker = get_broker()
+    if metrics_queue:
+        metrics.bind(metrics_queue)
     name = current_process().name
     logger.info(_(f"{name} monitoring at {current_process().pid}"))
-    for task in iter(result_queue.get, "STOP"):
-        # save the result
-        if task.get("cached", False):
-            save_cached(task, broker)
-        else:
-            save_task(task, broker)
-        # acknowledge result
-        ack_id = task.pop("ack_id", False)
-        if ack_id and (task["success"] or task.get("ack_failure", False)):
-            broker.acknowledge(ack_id)
-        # log the result
-        if task["success"]:
-            # log success
-            logger.info(_(f"Processed [{task['name']}]"))
-        else:
-            # log failure
-            logger.error(_(f"Failed [{task['name']}] - {task['result']}"))
+    pruner = Pruner()
+    pruner.start()
+    for tasks in drain(result_queue):
+        if TenantConf.COMPACT_TRANSPORT:
+            tasks = [task for task in (
+                expand(task, broker) if isinstance(task, Record) else task for task in tasks
+            ) if task]
+        # save the results
+        unsaved = save_tasks([task for task in tasks if not task.get("cached", False)], broker, pruner)
+        for task in tasks:
+            if task.get("cached", False):
+                save_cached(task, broker)
+            if task.get("fanout", None):
+                save_fanout(task, broker)
+        notify(tasks, broker)
+        for task in tasks:
+            # acknowledge result
+            ack_id = task.pop("ack_id", False)
+            start = perf_counter()
+            # a task whose row didn't commit is left for the broker to deliver again
+            committed = task["id"] not in unsaved
+            if ack_id and committed and (task["success"] or task.get("ack_failure", False)):
+                broker.acknowledge(ack_id)
+                metrics.observe("ack", perf_counter() - start, schema_of(task), task["func"])
+            elif ack_id and isinstance(broker, FairRedis):
+                # failures and unsaved tasks aren't retried by redis, they only give back their in flight slot
+                broker.acknowledge(ack_id)
+                metrics.observe("ack", perf_counter() - start, schema_of(task), task["func"])
+            # log the result
+            if task["success"]:
+                # log success
+                logger.info(_(f"Processed [{task['name']}]"))
+            else:
+                # log failure
+                logger.error(_(f"Failed [{task['name']}] - {task['result']}"))
+    pruner.stop()
+    metrics.flush()
     logger.info(_(f"{name} stopped monitoring results"))
 
 
-def save_task(task, broker):
+def notify(tasks, broker):
     """
-    Saves the task package to Django or the cache
+    Announces saved tasks on the channels of their id, name and group, waking up callers waiting for them
     """
-    # SAVE LIMIT < 0 : Don't save success
-    if not task.get("save", Conf.SAVE_LIMIT >= 0) and task["success"]:
+    if not TenantConf.NOTIFY or not isinstance(broker, Redis):
         return
-    # enqueues next in a chain
-    if task.get("chain", None):
-        QUtilities.create_async_tasks_chain(
-            task["chain"],
-            group=task["group"],
-            cached=task["cached"],
-            sync=task["sync"],
-            broker=broker,
-        )
-    # SAVE LIMIT > 0: Prune database, SAVE_LIMIT 0: No pruning
-    close_old_django_connections()
     try:
+        pipe = broker.connection.pipeline(transaction=False)
+        for task in tasks:
+            for key in {task["id"], task["name"], task.get("group", None)}:
+                if key:
+                    pipe.publish(QUtilities.done_channel(broker, key), task["id"])
+        pipe.execute()
+    except Exception as e:
+        logger.error(e)
 
-        kwargs = task.get('kwargs', {})
-        schema_name = kwargs.get('schema_name', None)
 
-        if schema_name:
+def drain(result_queue):
+    """
+    Yields batches of finished tasks from the result queue until it receives a STOP.
+    A batch holds up to MONITOR_BATCH_SIZE tasks, waiting at most MONITOR_BATCH_WAIT seconds for it to fill up
+    :type result_queue: multiprocessing.Queue
+    """
+    stopping = False
+    while not stopping:
+        task = result_queue.get()
+        if task == "STOP":
+            break
+        tasks = [task]
+        fill_until = time() + TenantConf.MONITOR_BATCH_WAIT
+        while len(tasks) < TenantConf.MONITOR_BATCH_SIZE:
+            remaining = fill_until - time()
+            try:
+                if remaining > 0:
+                    task = result_queue.get(timeout=remaining)
+                else:
+                    task = result_queue.get_nowait()
+            except Empty:
+                break
+            if task == "STOP":
+                stopping = True
+                break
+            tasks.append(task)
+        yield tasks
 
-            with schema_context(schema_name):
 
-                if task["success"] and 0 < Conf.SAVE_LIMIT <= Success.objects.count():
-                    Success.objects.last().delete()
-                # check if this task has previous results
-
-                if Task.objects.filter(id=task["id"], name=task["name"]).exists():
-                    existing_task = Task.objects.get(
-                        id=task["id"], name=task["name"])
-                    # only update the result if it hasn't succeeded yet
-                    if not existing_task.success:
-                        existing_task.stopped = task["stopped"]
-                        existing_task.result = task["result"]
-                        existing_task.success = task["success"]
-                        existing_task.save()
-                else:
-                    Task.objects.create(
-                        id=task["id"],
-                        name=task["name"],
-                        func=task["func"],
-                        hook=task.get("hook"),
-                        args=task["args"],
-                        kwargs=task["kwargs"],
-                        started=task["started"],
-                        stopped=task["stopped"],
-                        result=task["result"],
-                        group=task.get("group"),
-                        success=task["success"],
-                    )
-        else:
+def save_task(task, broker):
+    """
+    Saves the task package to Django or the cache
+    """
+    save_tasks([task], broker)
+
 
+def save_tasks(tasks, broker, pruner=None):
+    """
+    Saves a batch of task packages to Django, writing the tasks of each schema in a single transaction
+    :param pruner: keeps the number of successes under SAVE_LIMIT, without one the schema is pruned right away
+    :type pruner: Pruner
+    :return: the ids of the tasks whose rows failed to commit
+    """
+    unsaved = set()
+    schemas = {}
+    for task in tasks:
+        # SAVE LIMIT < 0 : Don't save success
+        if not task.get("save", Conf.SAVE_LIMIT >= 0) and task["success"]:
+            # no row will ever delete its blobs
+            blobs.discard(task)
+            continue
+        # enqueues next in a chain
+        if task.get("chain", None):
+            QUtilities.create_async_tasks_chain(
+                task["chain"],
+                group=task["group"],
+                cached=task["cached"],
+                sync=task["sync"],
+                broker=broker,
+            )
+        schema_name = task.get("kwargs", {}).get("schema_name", None)
+        if schema_name:
+            schemas.setdefault(schema_name, []).append(task)
+        else:
             logger.error('No schema name provided for saving the task')
+    if not schemas:
+        return unsaved
+    close_old_django_connections()
+    for schema_name, schema_tasks in schemas.items():
+        saved = []
+        start = perf_counter()
+        try:
+            with schema_context(schema_name):
+                with db.transaction.atomic():
+                    upsert_tasks(schema_tasks)
+            saved = schema_tasks
+            metrics.observe("save", perf_counter() - start, schema_name)
+        except Exception as e:
+            logger.error(e)
+            if len(schema_tasks) > 1:
+                # save them one by one so a single bad result doesn't lose the whole batch
+                for task in schema_tasks:
+                    try:
+                        with schema_context(schema_name):
+                            with db.transaction.atomic():
+                                upsert_tasks([task])
+                        saved.append(task)
+                    except Exception as e:
+                        logger.error(e)
+            saved_ids = {task["id"] for task in saved}
+            unsaved.update(task["id"] for task in schema_tasks if task["id"] not in saved_ids)
+        # SAVE LIMIT > 0: Prune database, SAVE_LIMIT 0: No pruning
+        successes = sum(1 for task in saved if task["success"])
+        if Conf.SAVE_LIMIT > 0 and successes:
+            if pruner:
+                pruner.add(schema_name, successes)
+            else:
+                try:
+                    with schema_context(schema_name):
+                        prune_successes(Success.objects.count() - Conf.SAVE_LIMIT)
+                except Exception as e:
+                    logger.error(e)
+    return unsaved
+
+
+def upsert_tasks(tasks):
+    """
+    Writes the tasks to the current schema with a single INSERT ... ON CONFLICT statement.
+    Existing tasks only get their result updated if they haven't succeeded yet
+    """
+    # keep one package per task id, preferring a successful one
+    packages = {}
+    for task in tasks:
+        if task["id"] not in packages or not packages[task["id"]]["success"]:
+            packages[task["id"]] = task
+    fields = Task._meta.concrete_fields
+    connection = db.connection
+    quote = connection.ops.quote_name
+    table = quote(Task._meta.db_table)
+    row = f"({', '.join(['%s'] * len(fields))})"
+    replaced = replaced_results(packages) if TenantConf.BLOB_THRESHOLD else {}
+    params = []
+    for task in packages.values():
+        # compact records come with their row prepared by the worker
+        params.extend(task["row"] if "row" in task else task_row(task))
+    sql = (
+        f"INSERT INTO {table} ({', '.join(quote(f.column) for f in fields)}) "
+        f"VALUES {', '.join([row] * len(packages))} "
+        f"ON CONFLICT ({quote(Task._meta.pk.column)}) DO UPDATE SET "
+        f"{quote('stopped')} = EXCLUDED.{quote('stopped')}, "
+        f"{quote('result')} = EXCLUDED.{quote('result')}, "
+        f"{quote('success')} = EXCLUDED.{quote('success')} "
+        f"WHERE NOT {table}.{quote('success')}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+    # the blobs of the results that were overwritten
+    keys = []
+    for task_id, result in replaced.items():
+        kept = set(blobs.refs(packages[task_id].get("result")))
+        keys.extend(key for key in blobs.refs(result) if key not in kept)
+    if keys:
+        db.transaction.on_commit(lambda: blobs.delete(keys))
+
+
+def replaced_results(packages):
+    """
+    The results of the failed tasks the packages are about to overwrite, locked until the upsert is done
+    :return: dict of the results by task id
+    """
+    failed = Task.objects.select_for_update().filter(pk__in=list(packages), success=False)
+    return dict(failed.values_list("id", "result"))
+
+
+def task_row(task):
+    """
+    The values of a task package as they are written to the Task table
+    """
+    instance = Task(
+        id=task["id"],
+        name=task["name"],
+        func=task["func"],
+        hook=task.get("hook"),
+        args=task["args"],
+        kwargs=task["kwargs"],
+        started=task["started"],
+        stopped=task["stopped"],
+        result=task["result"],
+        group=task.get("group"),
+        success=task["success"],
+    )
+    connection = db.connection
+    return [f.get_db_prep_save(getattr(instance, f.attname), connection) for f in Task._meta.concrete_fields]
+
+
+# position of the result in a task row
+RESULT_INDEX = [f.attname for f in Task._meta.concrete_fields].index("result")
 
-    except Exception as e:
-        logger.error(e)
+
+def prune_successes(overflow):
+    """
+    Deletes the oldest successes of the current schema in a single statement
+    :param int overflow: the number of successes to delete
+    :return: the number of deleted successes
+    """
+    if overflow <= 0:
+        return 0
+    oldest = Success.objects.order_by("stopped").values("pk")[:overflow]
+    deleted, __ = Task.objects.filter(pk__in=oldest).delete()
+    return deleted
+
+
+class Pruner(object):
+    """
+    Keeps the successes of every schema under SAVE_LIMIT from a background thread of the monitor.
+    Success counts are tracked in memory so the database is only counted once per schema,
+    and at most PRUNE_BATCH successes are deleted per schema on every pass.
+    """
+
+    def __init__(self, interval=None, batch=None):
+        self.interval = interval or TenantConf.PRUNE_INTERVAL
+        self.batch = batch or TenantConf.PRUNE_BATCH
+        self.counts = {}
+        self.added = {}
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if Conf.SAVE_LIMIT <= 0:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.event.set()
+        self.thread.join()
+        self.thread = None
+
+    def add(self, schema_name, successes):
+        """
+        Records newly saved successes for a schema
+        """
+        with self.lock:
+            self.added[schema_name] = self.added.get(schema_name, 0) + successes
+
+    def run(self):
+        while not self.event.wait(self.interval):
+            self.prune()
+        # one last pass for what came in while stopping
+        self.prune()
+        db.connection.close()
+
+    def prune(self):
+        with self.lock:
+            added, self.added = self.added, {}
+        close_old_django_connections()
+        for schema_name in set(added) | {s for s, c in self.counts.items() if c > Conf.SAVE_LIMIT}:
+            try:
+                with schema_context(schema_name):
+                    count = self.counts.get(schema_name)
+                    if count is None:
+                        count = Success.objects.count()
+                    else:
+                        count += added.get(schema_name, 0)
+                    overflow = min(count - Conf.SAVE_LIMIT, self.batch)
+                    deleted = prune_successes(overflow)
+                    if deleted < overflow:
+                        # someone else deleted rows, count again on the next pass
+                        self.counts.pop(schema_name, None)
+                    else:
+                        self.counts[schema_name] = count - deleted
+            except Exception as e:
+                self.counts.pop(schema_name, None)
+                logger.error(e)
 
 
 def save_cached(task, broker):
@@ -595,99 +1869,202 @@ def save_cached(task, broker):
         logger.error(e)
 
 
-def scheduler(broker=None):
+def scheduler(broker=None, schema_names=None, event=None):
     """
     Creates a task from a schedule at the scheduled time and schedules next run
+    :param schema_names: the schemas to visit, defaults to every schema with due schedules
+    :type event: multiprocessing.Event
     """
     if not broker:
         broker = get_broker()
     close_old_django_connections()
+    if schema_names is None:
+        schema_names = scheduled_schemas()
+
+    for schema_name in schema_names:
+        if event and event.is_set():
+            break
+        try:
+            with schema_context(schema_name):
+                for pk, s, args, kwargs in claim_schedules():
+                    # send it to the cluster
+                    kwargs["q_options"]["broker"] = broker
+                    s.task = QUtilities.add_async_task(
+                        s.func, *args, **kwargs)
+                    # log it
+                    if not s.task:
+                        logger.error(
+                            _(
+                                f"{current_process().name} failed to create a task from schedule "
+                                f"[{s.name or pk}] under tenant {schema_name}"
+                            )
+                        )
+                    else:
+                        logger.info(
+                            _(
+                                f"{current_process().name} created a task from schedule "
+                                f"[{s.name or pk}] under tenant {schema_name}"
+                            )
+                        )
+                        Schedule.objects.filter(pk=pk).update(task=s.task)
+        except Exception as e:
+            logger.error(e)
+
+
+def claim_schedules():
+    """
+    Claims the due schedules of the current schema in a short transaction and returns them with their arguments.
+    Rows locked by another scheduler are skipped, the tasks are only enqueued once the claim has been committed.
+    """
+    claimed = []
+    with db.transaction.atomic():
+        for s in (
+            Schedule.objects.select_for_update(skip_locked=True)
+            .exclude(repeats=0)
+            .filter(next_run__lt=timezone.now())
+        ):
+            args = ()
+            kwargs = {}
+            # get args, kwargs and hook
+            if s.kwargs:
+                try:
+                    # eval should be safe here because dict()
+                    kwargs = eval(f"dict({s.kwargs})")
+                except SyntaxError:
+                    kwargs = {}
+            if s.args:
+                args = ast.literal_eval(s.args)
+                # single value won't eval to tuple, so:
+                if type(args) != tuple:
+                    args = (args,)
+            q_options = kwargs.get("q_options", {})
+            if s.hook:
+                q_options["hook"] = s.hook
+            q_options["group"] = q_options.get("group", s.name or s.id)
+            kwargs["q_options"] = q_options
+            # set up the next run time
+            if not s.schedule_type == s.ONCE:
+                next_run = arrow.get(s.next_run)
+                while True:
+                    if s.schedule_type == s.MINUTES:
+                        next_run = next_run.shift(
+                            minutes=+(s.minutes or 1))
+                    elif s.schedule_type == s.HOURLY:
+                        next_run = next_run.shift(hours=+1)
+                    elif s.schedule_type == s.DAILY:
+                        next_run = next_run.shift(days=+1)
+                    elif s.schedule_type == s.WEEKLY:
+                        next_run = next_run.shift(weeks=+1)
+                    elif s.schedule_type == s.MONTHLY:
+                        next_run = next_run.shift(months=+1)
+                    elif s.schedule_type == s.QUARTERLY:
+                        next_run = next_run.shift(months=+3)
+                    elif s.schedule_type == s.YEARLY:
+                        next_run = next_run.shift(years=+1)
+                    elif s.schedule_type == s.CRON:
+                        next_run = croniter(s.cron, timezone.datetime.now()).get_next(timezone.datetime)
+                    if Conf.CATCH_UP or next_run > arrow.utcnow():
+                        break
+                if s.schedule_type == s.CRON:
+                    s.next_run = next_run
+                else:
+                    s.next_run = next_run.datetime
+                s.repeats += -1
+            claimed.append((s.pk, s, args, kwargs))
+            # default behavior is to delete a ONCE schedule
+            if s.schedule_type == s.ONCE:
+                if s.repeats < 0:
+                    s.delete()
+                    continue
+                # but not if it has a positive repeats
+                s.repeats = 0
+            # save the schedule
+            s.save()
+    return claimed
+
+
+def schedule_runner(event, cluster_id, broker=None):
+    """
+    Runs the scheduler every SCHEDULER_INTERVAL seconds,
+    sweeping this cluster's share of the schemas with a pool of threads
+    :type event: multiprocessing.Event
+    """
+    if not broker:
+        broker = get_broker()
+    name = current_process().name
+    logger.info(_(f"{name} scheduling at {current_process().pid}"))
+    threads = max(TenantConf.SCHEDULER_THREADS, 1)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while not event.is_set():
+            started = time()
+            try:
+                close_old_django_connections()
+                schema_names = cluster_share(scheduled_schemas(), cluster_id, broker, overdue_schemas())
+                sweeps = [
+                    pool.submit(scheduler, broker, schema_names[i::threads], event)
+                    for i in range(min(threads, len(schema_names)))
+                ]
+                for sweep in sweeps:
+                    sweep.result()
+                logger.debug(_(f"{name} swept {len(schema_names)} schemas in {time() - started:.2f}s"))
+            except Exception as e:
+                logger.error(e)
+            event.wait(max(TenantConf.SCHEDULER_INTERVAL - (time() - started), 0))
+    logger.info(_(f"{name} stopped scheduling"))
+
+
+def cluster_share(schema_names, cluster_id, broker, overdue=()):
+    """
+    Returns the schemas this cluster schedules, spreading them over all running clusters
+    :param overdue: schemas every cluster sweeps, whoever owns them
+    """
+    cluster_ids = [stat.cluster_id for stat in get_all(broker=broker)]
+    return share(schema_names, cluster_id, cluster_ids, overdue)
+
+
+def share(schema_names, cluster_id, cluster_ids, overdue=()):
+    """
+    Splits the schemas over the clusters by a hash of their name. While clusters come and go the nodes can
+    disagree on the clusters, and a schema nobody thinks it owns is caught up through the overdue schemas.
+    """
+    cluster_ids = sorted({str(c) for c in cluster_ids} | {str(cluster_id)})
+    index = cluster_ids.index(str(cluster_id))
+    return [
+        schema_name for schema_name in schema_names
+        if zlib.crc32(schema_name.encode()) % len(cluster_ids) == index or schema_name in overdue
+    ]
+
+
+def overdue_schemas():
+    """
+    Returns the names of the schemas with a schedule that was due a whole scheduler run ago,
+    which their owner should have swept by now. Only the schedule index knows them.
+    """
+    if not TenantConf.SCHEDULE_INDEX:
+        return set()
+    late = timezone.now() - timedelta(seconds=TenantConf.SCHEDULER_INTERVAL)
+    return set(
+        ScheduleIndex.objects.filter(next_run__lt=late).order_by().values_list("schema_name", flat=True).distinct()
+    )
+
+
+def scheduled_schemas():
+    """
+    Returns the names of the tenant schemas the scheduler has to visit.
+    With the schedule index enabled only schemas that have a due schedule are returned.
+    """
     tenant_model = get_tenant_model()
     tenant_schemas_to_exclude = getattr(
         settings, 'SCHEMAS_TO_BE_EXCLUDED_BY_SCHEDULER', ['public'])
+    tenants = tenant_model.objects.exclude(schema_name__in=tenant_schemas_to_exclude)
 
-    try:
-        for tenant in tenant_model.objects.exclude(schema_name__in=tenant_schemas_to_exclude):
-            with schema_context(tenant.schema_name):
-                with db.transaction.atomic():
-                    for s in (
-                        Schedule.objects.select_for_update()
-                        .exclude(repeats=0)
-                        .filter(next_run__lt=timezone.now())
-                    ):
-                        args = ()
-                        kwargs = {}
-                        # get args, kwargs and hook
-                        if s.kwargs:
-                            try:
-                                # eval should be safe here because dict()
-                                kwargs = eval(f"dict({s.kwargs})")
-                            except SyntaxError:
-                                kwargs = {}
-                        if s.args:
-                            args = ast.literal_eval(s.args)
-                            # single value won't eval to tuple, so:
-                            if type(args) != tuple:
-                                args = (args,)
-                        q_options = kwargs.get("q_options", {})
-                        if s.hook:
-                            q_options["hook"] = s.hook
-                        # set up the next run time
-                        if not s.schedule_type == s.ONCE:
-                            next_run = arrow.get(s.next_run)
-                            while True:
-                                if s.schedule_type == s.MINUTES:
-                                    next_run = next_run.shift(
-                                        minutes=+(s.minutes or 1))
-                                elif s.schedule_type == s.HOURLY:
-                                    next_run = next_run.shift(hours=+1)
-                                elif s.schedule_type == s.DAILY:
-                                    next_run = next_run.shift(days=+1)
-                                elif s.schedule_type == s.WEEKLY:
-                                    next_run = next_run.shift(weeks=+1)
-                                elif s.schedule_type == s.MONTHLY:
-                                    next_run = next_run.shift(months=+1)
-                                elif s.schedule_type == s.QUARTERLY:
-                                    next_run = next_run.shift(months=+3)
-                                elif s.schedule_type == s.YEARLY:
-                                    next_run = next_run.shift(years=+1)
-                                elif s.schedule_type == s.CRON:
-                                    next_run = croniter(s.cron, timezone.datetime.now()).get_next(timezone.datetime)
-                                if Conf.CATCH_UP or next_run > arrow.utcnow():
-                                    break
-                            if s.schedule_type == s.CRON:
-                                s.next_run = next_run
-                            else:
-                                s.next_run = next_run.datetime
-                            s.repeats += -1
-                        # send it to the cluster
-                        q_options["broker"] = broker
-                        q_options["group"] = q_options.get(
-                            "group", s.name or s.id)
-                        kwargs["q_options"] = q_options
-                        s.task = QUtilities.add_async_task(
-                            s.func, *args, **kwargs)
-                        # log it
-                        if not s.task:
-                            logger.error(
-                                _(
-                                    f"{current_process().name} failed to create a task from schedule [{s.name or s.id}] under tenant {kwargs.get('schema_name', 'UNSPECIFIED')}"
-                                )
-                            )
-                        else:
-                            logger.info(
-                                _(
-                                    f"{current_process().name} created a task from schedule [{s.name or s.id}] under tenant {kwargs.get('schema_name', 'UNSPECIFIED')}"
-                                )
-                            )
-                        # default behavior is to delete a ONCE schedule
-                        if s.schedule_type == s.ONCE:
-                            if s.repeats < 0:
-                                s.delete()
-                                continue
-                            # but not if it has a positive repeats
-                            s.repeats = 0
-                        # save the schedule
-                        s.save()
-    except Exception as e:
-        logger.error(e)
+    if TenantConf.SCHEDULE_INDEX:
+        due = (
+            ScheduleIndex.objects.filter(next_run__lt=timezone.now())
+            .filter(schema_name__in=tenants.values("schema_name"))
+            .order_by()
+            .values_list("schema_name", flat=True)
+            .distinct()
+        )
+        return list(due)
+    return list(tenants.values_list("schema_name", flat=True))
@@ -0,0 +1,175 @@
+# Standard
+import hmac
+import hashlib
+from datetime import datetime
+
+# Django
+from django.conf import settings
+
+# Local
+from django_q.conf import logger
+from django_q.signing import BadSignature, SignedPackage
+from django_tenant_schemas_q.conf import TenantConf
+
+# optional
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Packages of this module start with MAGIC and a version byte, packages of SignedPackage never do
+MAGIC = b"\xd7"
+VERSION = 1
+CODECS = {"msgpack": 1, "orjson": 2}
+COMPRESSED = 1
+HEADER_SIZE = 4
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+_key = None
+
+
+def key():
+    # the signing key, derived from the SECRET_KEY once
+    global _key
+    if _key is None:
+        _key = hashlib.sha256(f"django_tenant_schemas_q.codec{settings.SECRET_KEY}".encode()).digest()
+    return _key
+
+
+def encode_msgpack(obj):
+    return msgpack.packb(obj, datetime=True)
+
+
+def decode_msgpack(data):
+    return msgpack.unpackb(data, timestamp=3, strict_map_key=False)
+
+
+def tag(obj):
+    # orjson hands the datetimes over to keep their type
+    if isinstance(obj, datetime):
+        return {"__datetime__": obj.isoformat()}
+    raise TypeError
+
+
+def untag(obj):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        return {k: untag(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [untag(v) for v in obj]
+    return obj
+
+
+def encode_orjson(obj):
+    return orjson.dumps(obj, default=tag, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def decode_orjson(data):
+    obj = orjson.loads(data)
+    if b'"__datetime__"' in data:
+        obj = untag(obj)
+    return obj
+
+
+# the types msgpack and orjson give back as they got them
+PLAIN = (str, int, float, bool, bytes, datetime, type(None))
+
+
+def plain(value):
+    """
+    Whether a value comes back from msgpack and orjson with the same types. They turn tuples into lists,
+    UUIDs into strings and flatten dataclasses, enums and subclasses of the plain types, so those are pickled
+    """
+    kind = type(value)
+    if kind in PLAIN:
+        return True
+    if kind is list:
+        return all(plain(v) for v in value)
+    if kind is dict:
+        return all(type(k) is str and plain(v) for k, v in value.items())
+    return False
+
+
+def lossless(obj):
+    # the arguments of a task are the one tuple loads turns back into a tuple
+    if type(obj) is not dict:
+        return plain(obj)
+    return all(
+        type(key) is str and (plain(value) or key == "args" and type(value) is tuple and plain(list(value)))
+        for key, value in obj.items()
+    )
+
+
+ENCODERS = {1: encode_msgpack, 2: encode_orjson}
+DECODERS = {1: decode_msgpack, 2: decode_orjson}
+
+
+def available(name):
+    return (name == "msgpack" and msgpack is not None) or (name == "orjson" and orjson is not None)
+
+
+def dumps(obj, codec=None):
+    """
+    Signs and serializes a task package with CODEC.
+    Packages the codec can't serialize or would change the types of, like ones holding model instances
+    or UUIDs, fall back to SignedPackage
+    :param codec: overrides the CODEC setting
+    """
+    codec = codec or TenantConf.CODEC
+    if codec not in CODECS or not available(codec):
+        if codec != "pickle":
+            logger.error(f"Codec {codec} is not available, using pickle")
+        return SignedPackage.dumps(obj)
+    if not lossless(obj):
+        return SignedPackage.dumps(obj)
+    codec_id = CODECS[codec]
+    try:
+        payload = ENCODERS[codec_id](obj)
+    except (TypeError, ValueError, OverflowError):
+        return SignedPackage.dumps(obj)
+    flags = 0
+    if zstandard and TenantConf.CODEC_COMPRESS_SIZE and len(payload) > TenantConf.CODEC_COMPRESS_SIZE:
+        payload = zstandard.ZstdCompressor().compress(payload)
+        flags |= COMPRESSED
+    header = MAGIC + bytes((VERSION, codec_id, flags))
+    digest = hmac.new(key(), header + payload, hashlib.sha256).digest()
+    return header + digest + payload
+
+
+def loads(data):
+    """
+    Checks and deserializes a task package of any codec, including the SignedPackage ones of older versions
+    """
+    if isinstance(data, str):
+        return SignedPackage.loads(data)
+    if data[:1] != MAGIC:
+        return SignedPackage.loads(data)
+    header = data[:HEADER_SIZE]
+    version, codec_id, flags = header[1], header[2], header[3]
+    if version > VERSION or codec_id not in DECODERS:
+        raise BadSignature(f"Unknown package version {version} or codec {codec_id}")
+    digest = data[HEADER_SIZE:HEADER_SIZE + DIGEST_SIZE]
+    payload = data[HEADER_SIZE + DIGEST_SIZE:]
+    if not hmac.compare_digest(digest, hmac.new(key(), header + payload, hashlib.sha256).digest()):
+        raise BadSignature("Package signature does not match")
+    if flags & COMPRESSED:
+        if not zstandard:
+            raise BadSignature("Package is compressed with zstd but zstandard isn't installed")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    obj = DECODERS[codec_id](payload)
+    # arrays come back as lists, the task arguments are a tuple
+    if isinstance(obj, dict) and isinstance(obj.get("args"), list):
+        obj["args"] = tuple(obj["args"])
+    return obj
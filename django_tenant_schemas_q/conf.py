@@ -0,0 +1,134 @@
+# local
+from django_q.conf import Conf
+
+
+class TenantConf(object):
+    """
+    Configuration options of the multi tenant cluster. These are read from the Q_CLUSTER setting
+    next to the options consumed by Django Q itself
+    """
+
+    conf = Conf.conf
+
+    # Keep a public schema index of schedule due times so the scheduler only visits schemas with due schedules.
+    # Requires django_tenant_schemas_q in SHARED_APPS. Defaults to False
+    SCHEDULE_INDEX = conf.get("schedule_index", False)
+
+    # Seconds between two scheduler sweeps
+    SCHEDULER_INTERVAL = conf.get("scheduler_interval", 30)
+
+    # Number of threads sweeping the tenant schemas for due schedules
+    SCHEDULER_THREADS = conf.get("scheduler_threads", 4)
+
+    # Maximum number of results the monitor saves in one batch
+    MONITOR_BATCH_SIZE = conf.get("monitor_batch_size", 100)
+
+    # Seconds the monitor waits for a batch to fill up. 0 only takes the results that are already waiting
+    MONITOR_BATCH_WAIT = conf.get("monitor_batch_wait", 0)
+
+    # Seconds between two passes of the monitor pruning successes over SAVE_LIMIT
+    PRUNE_INTERVAL = conf.get("prune_interval", 10)
+
+    # Maximum number of successes deleted per schema on every pruning pass
+    PRUNE_BATCH = conf.get("prune_batch", 1000)
+
+    # Number of resolved task functions each worker keeps cached
+    FUNC_CACHE_SIZE = conf.get("func_cache_size", 256)
+
+    # Task modules imported by every worker when it starts
+    PRELOAD = conf.get("preload", [])
+
+    # Give every worker its own queue and dispatch tasks to the worker owning their schema. Defaults to False
+    AFFINITY = conf.get("affinity", False)
+
+    # Seconds a worker waits on its own queue before stealing tasks from the other workers with schema affinity
+    STEAL_WAIT = conf.get("steal_wait", 0.1)
+
+    # Number of tasks the FairRedis broker takes from a schema on its turn, unless set in TENANT_WEIGHTS
+    TENANT_WEIGHT = conf.get("tenant_weight", 1)
+
+    # Turn sizes per schema for the FairRedis broker, e.g. {"bigcustomer": 5}
+    TENANT_WEIGHTS = conf.get("tenant_weights", {})
+
+    # Maximum number of tasks of a single schema in flight with the FairRedis broker. 0 means no limit
+    TENANT_MAX_IN_FLIGHT = conf.get("tenant_max_in_flight", 0)
+
+    # Number of packages QUtilities.add_async_tasks_bulk sends to the broker in one round trip
+    ENQUEUE_CHUNK_SIZE = conf.get("enqueue_chunk_size", 500)
+
+    # Seconds the counters and results of a fan out are kept in the cache
+    FANOUT_TIMEOUT = conf.get("fanout_timeout", 86400)
+
+    # Schemas a fan out skips, independent of SCHEMAS_TO_BE_EXCLUDED_BY_SCHEDULER. Defaults to ["public"]
+    FANOUT_EXCLUDE = conf.get("fanout_exclude", ["public"])
+
+    # Announce finished tasks over redis pub/sub so waiting calls wake up instead of polling. Defaults to True
+    NOTIFY = conf.get("notify", True)
+
+    # Seconds between checks of a waiting call in case an announcement was missed
+    NOTIFY_POLL = conf.get("notify_poll", 1)
+
+    # Port the sentinel serves the stage metrics on in the Prometheus text format. 0 turns the metrics off
+    METRICS_PORT = conf.get("metrics_port", 0)
+
+    # Address the metrics are served on, all interfaces by default
+    METRICS_HOST = conf.get("metrics_host", "")
+
+    # Seconds the status of a cluster lives in the broker. It's refreshed every third of it or when it changes
+    STATUS_TTL = conf.get("status_ttl", 10)
+
+    # Number of pusher processes pulling tasks from the broker
+    PUSHERS = conf.get("pushers", 1)
+
+    # Seconds of work the pushers keep queued per worker, sized with the recent execution time of the tasks.
+    # Capped at half of RETRY so prefetched tasks don't outlive their broker visibility timeout
+    PREFETCH_WINDOW = conf.get("prefetch_window", 1)
+
+    # Pass the signed packages to the workers undecoded and send plain successful results back to the monitor
+    # as compact records with their database row prepared by the worker. Defaults to False
+    COMPACT_TRANSPORT = conf.get("compact_transport", False)
+
+    # Size in bytes above which a compact record hands its result to the monitor through shared memory. 0 never does
+    COMPACT_SHM_SIZE = conf.get("compact_shm_size", 65536)
+
+    # Serializer of the task packages: "pickle" for Django Q's SignedPackage, "msgpack" or "orjson" signed with HMAC.
+    # Packages the codec can't serialize fall back to pickle and every codec reads the packages of the others
+    CODEC = conf.get("codec", "pickle")
+
+    # Size in bytes above which msgpack and orjson packages are compressed with zstd, if zstandard is installed.
+    # 0 never does
+    CODEC_COMPRESS_SIZE = conf.get("codec_compress_size", 0)
+
+    # Size in bytes above which task arguments and results are kept in the blob store with only a reference
+    # in the broker, the cache and the database. 0 keeps everything inline
+    BLOB_THRESHOLD = conf.get("blob_threshold", 0)
+
+    # Dotted path of the blob store class
+    BLOB_STORE = conf.get("blob_store", "django_tenant_schemas_q.blobs.FileSystemStore")
+
+    # Directory of the file system blob store, shared by all clusters and clients. Defaults to a temporary directory
+    BLOB_PATH = conf.get("blob_path", None)
+
+    # Kind of worker: "process" runs one task at a time, "thread" runs WORKER_SLOTS threads and "asyncio"
+    # awaits up to WORKER_SLOTS coroutine tasks on an event loop. Defaults to "process"
+    WORKER_TYPE = conf.get("worker_type", "process")
+
+    # Number of tasks a thread or asyncio worker runs at the same time
+    WORKER_SLOTS = conf.get("worker_slots", 8)
+
+    # Fork the workers from a template process with Django set up and the PRELOAD modules imported, using the
+    # forkserver start method, so new and reincarnated workers start warm. Defaults to False
+    WORKER_TEMPLATE = conf.get("worker_template", False)
+
+    # Megabytes of resident memory after which a worker is recycled once its task is done. 0 never recycles on memory.
+    # It also measures what every task grows its worker by, logged when the worker stops. Defaults to Django Q's max_rss
+    MAX_MEMORY = conf.get("max_memory", (conf.get("max_rss") or 0) / 1024)
+
+    # Seconds a process worker task gets to clean up after SoftTimeout is raised in it at its timeout, before
+    # the worker is killed. 0 kills the worker right at the timeout
+    TIMEOUT_GRACE = conf.get("timeout_grace", 0)
+
+    # Seconds a stopping cluster gives its running tasks to finish. Tasks that were prefetched but not started go back
+    # to the broker right away and workers still running a task at the deadline are killed. 0 waits for every task
+    # in the queues to be done
+    DRAIN_TIMEOUT = conf.get("drain_timeout", 0)
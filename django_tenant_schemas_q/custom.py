@@ -1,8 +1,19 @@
+# standard
+import importlib
+
+# django
+from django.db import connection
+
 # local
+from django_tenant_schemas_q.conf import TenantConf
 from django_tenant_schemas_q.utils import QUtilities
+from django_tenant_schemas_q import blobs
 
-from django_q.conf import Conf
+from django_q.conf import Conf, logger
+from django_q.humanhash import uuid
 from django_q.brokers import get_broker
+from django_q.signing import SignedPackage
+from tenant_schemas.utils import get_tenant_model
 
 
 class Iter(object):
@@ -247,6 +258,23 @@ class AsyncTask(object):
         if self.started:
             return QUtilities.get_result(self.id, wait=wait, cached=self.cached)
 
+    async def arun(self):
+        self.id = await QUtilities.aadd_async_task(self.func, *self.args, **self.kwargs)
+        self.started = True
+        return self.id
+
+    async def aresult(self, wait=0):
+
+        if self.started:
+            return await QUtilities.aget_result(
+                self.id, self.kwargs.get("schema_name"), wait=wait, cached=self.cached)
+
+    async def afetch(self, wait=0):
+
+        if self.started:
+            return await QUtilities.afetch_task(
+                self.id, self.kwargs.get("schema_name"), wait=wait, cached=self.cached)
+
     def fetch(self, wait=0):
 
         if self.started:
@@ -273,3 +301,215 @@ class AsyncTask(object):
                 count=count,
                 cached=self.cached,
             )
+
+
+class FanOut(object):
+    """
+    Runs a function once in every tenant schema, optionally folding the results of all tenants with a reduce function
+    """
+
+    def __init__(self, func, *args, reduce=None, initial=None, batch_size=None, broker=None, **kwargs):
+        self.id = ""
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.reduce = reduce
+        self.initial = initial
+        self.batch_size = batch_size or TenantConf.ENQUEUE_CHUNK_SIZE
+        self.broker = broker or get_broker()
+        self.started = False
+
+    def run(self):
+        """
+        Start queueing the function for every tenant, streaming the tenants in batches
+        :return: the fan out id
+        """
+        self.id = uuid()[1]
+        key = fanout_key(self.broker.list_key, self.id)
+        cache = self.broker.cache
+        timeout = TenantConf.FANOUT_TIMEOUT
+        # hold one count until every tenant is enqueued, so the fan out can't finish early
+        cache.set(f"{key}:remaining", 1, timeout)
+        cache.set(f"{key}:completed", 0, timeout)
+        cache.set(f"{key}:failed", 0, timeout)
+        kwargs = dict(self.kwargs)
+        if "q_options" in kwargs:
+            kwargs["q_options"] = options = dict(kwargs["q_options"])
+        else:
+            options = kwargs
+        if self.reduce:
+            cache.set(f"{key}:results", 0, timeout)
+            cache.set(
+                f"{key}:reduce",
+                SignedPackage.dumps({
+                    "func": self.reduce,
+                    "initial": self.initial,
+                    "schema_name": connection.schema_name,
+                    "sync": options.get("sync", Conf.SYNC),
+                }),
+                timeout,
+            )
+        options["broker"] = self.broker
+        options["group"] = self.id
+        options["fanout"] = {"id": self.id, "reduce": bool(self.reduce)}
+
+        total = 0
+        for schema_names in self.batches():
+            cache.incr(f"{key}:remaining", len(schema_names))
+            packs = []
+            for schema_name in schema_names:
+                kwargs["schema_name"] = schema_name
+                tag, task, broker, pack = QUtilities.prepare_task(self.func, *self.args, **kwargs)
+                if task.get("sync", False):
+                    QUtilities.run_synchronously(pack)
+                else:
+                    packs.append(pack)
+            if packs:
+                QUtilities.enqueue_many(self.broker, packs, schema_names)
+            total += len(schema_names)
+        cache.set(f"{key}:total", total, timeout)
+        self.started = True
+        # release our count
+        if cache.decr(f"{key}:remaining") == 0:
+            finish_fanout(self.id, self.broker)
+        return self.id
+
+    def batches(self):
+        """
+        Yields the names of the tenant schemas in lists of batch_size
+        """
+        schema_names = (
+            get_tenant_model().objects.exclude(schema_name__in=TenantConf.FANOUT_EXCLUDE)
+            .order_by("pk")
+            .values_list("schema_name", flat=True)
+            .iterator(chunk_size=self.batch_size)
+        )
+        batch = []
+        for schema_name in schema_names:
+            batch.append(schema_name)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def total(self):
+        """
+        get the number of tenants the function was enqueued for
+        :return int: the number of tenants, None while still enqueueing
+        """
+        if self.started:
+            return self.broker.cache.get(f"{fanout_key(self.broker.list_key, self.id)}:total")
+
+    def completed(self):
+        """
+        get the number of tenants that finished, including failures
+        :return int: the number of finished tenants
+        """
+        if self.started:
+            return self.broker.cache.get(f"{fanout_key(self.broker.list_key, self.id)}:completed") or 0
+
+    def failed(self):
+        """
+        get the number of tenants that failed
+        :return int: the number of failed tenants
+        """
+        if self.started:
+            return self.broker.cache.get(f"{fanout_key(self.broker.list_key, self.id)}:failed") or 0
+
+    def result(self, wait=0):
+        """
+        return the reduced result of all tenants once the reduce task has run.
+        :param int wait: how many milliseconds to wait for a result
+        :return: the reduced result, None if the reduce task failed
+        """
+        if not self.started or not self.reduce:
+            return None
+        key = f"{fanout_key(self.broker.list_key, self.id)}:result"
+
+        def check():
+            pack = self.broker.cache.get(key)
+            return SignedPackage.loads(pack) if pack else None
+
+        # the fold task announces itself on its name when it finishes
+        outcome = QUtilities.wait_for(check, [fold_name(self.id)], wait, self.broker)
+        if outcome and outcome["success"]:
+            return outcome["result"]
+
+
+def fanout_key(list_key, fanout_id):
+    return f"{list_key}:{fanout_id}:fanout"
+
+
+def fold_name(fanout_id):
+    return f"{fanout_id}-fold"
+
+
+def save_fanout(task, broker):
+    """
+    Counts a finished tenant task of a fan out and keeps its result for the reduce task.
+    The task finishing the fan out enqueues the reduce task.
+    """
+    fanout = task["fanout"]
+    key = fanout_key(broker.list_key, fanout["id"])
+    cache = broker.cache
+    try:
+        if task["success"]:
+            if fanout.get("reduce", False):
+                index = cache.incr(f"{key}:results")
+                cache.set(f"{key}:result:{index}", SignedPackage.dumps(task["result"]), TenantConf.FANOUT_TIMEOUT)
+        else:
+            cache.incr(f"{key}:failed")
+        cache.incr(f"{key}:completed")
+        if cache.decr(f"{key}:remaining") == 0:
+            finish_fanout(fanout["id"], broker)
+    except Exception as e:
+        logger.error(e)
+
+
+def finish_fanout(fanout_id, broker):
+    """
+    Enqueues the reduce task of a finished fan out, in the schema the fan out was started from
+    """
+    pack = broker.cache.get(f"{fanout_key(broker.list_key, fanout_id)}:reduce")
+    if not pack:
+        return
+    spec = SignedPackage.loads(pack)
+    QUtilities.add_async_task(
+        "django_tenant_schemas_q.custom.fold",
+        fanout_id,
+        broker.list_key,
+        schema_name=spec["schema_name"],
+        q_options={"broker": broker, "save": False, "sync": spec["sync"], "task_name": fold_name(fanout_id)},
+    )
+
+
+def fold(fanout_id, list_key=None):
+    """
+    Reduces the results of a fan out one at a time, so they never have to be in memory all at once.
+    The outcome is kept in the cache, a failure included, so FanOut.result stops waiting either way
+    :param str list_key: the list key of the broker the fan out was started on, the default broker's if None
+    :return: the reduced result
+    """
+    broker = get_broker()
+    key = fanout_key(list_key or broker.list_key, fanout_id)
+    cache = broker.cache
+    try:
+        spec = SignedPackage.loads(cache.get(f"{key}:reduce"))
+        f = spec["func"]
+        if not callable(f):
+            module, func = f.rsplit(".", 1)
+            f = getattr(importlib.import_module(module), func)
+        value = spec["initial"]
+        for index in range(1, (cache.get(f"{key}:results") or 0) + 1):
+            pack = cache.get(f"{key}:result:{index}")
+            if pack is None:
+                continue
+            value = f(value, blobs.fetch(SignedPackage.loads(pack)))
+            cache.delete(f"{key}:result:{index}")
+    except Exception as e:
+        cache.set(f"{key}:result", SignedPackage.dumps({"success": False, "result": str(e)}), TenantConf.FANOUT_TIMEOUT)
+        raise
+    cache.set(f"{key}:result", SignedPackage.dumps({"success": True, "result": value}), TenantConf.FANOUT_TIMEOUT)
+    cache.delete_many([f"{key}:reduce", f"{key}:results"])
+    return value
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from django_tenant_schemas_q import benchmark
+
+
+class Command(BaseCommand):
+    # Translators: help text for msbenchmark management command
+    help = _(
+        "Benchmarks enqueueing, the cluster and the scheduler across a number of tenant schemas.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tenants',
+            type=int,
+            default=10,
+            help='Number of benchmark tenants to create.',
+        )
+        parser.add_argument(
+            '--tasks',
+            type=int,
+            default=1000,
+            help='Number of tasks per run, spread over the tenants.',
+        )
+        parser.add_argument(
+            '--workers',
+            default='1,2,4',
+            help='Comma separated worker counts to run the cluster with.',
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='File to write the json results to, defaults to stdout.',
+        )
+        parser.add_argument(
+            '--codecs',
+            action='store_true',
+            default=False,
+            help='Only compare the package codecs, without tenants or a cluster.',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            default=False,
+            help='Keep the benchmark tenants after the run.',
+        )
+
+    def handle(self, *args, **options):
+        if options['codecs']:
+            benchmark.dump({'codecs': benchmark.codecs()}, options['output'])
+            return
+        workers = [int(count) for count in options['workers'].split(',') if count]
+        results = benchmark.run(
+            tenants=options['tenants'],
+            tasks=options['tasks'],
+            workers=workers,
+            keep=options['keep'],
+        )
+        benchmark.dump(results, options['output'])
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.translation import gettext as _
+
+from django_q.models import Schedule
+from tenant_schemas.utils import schema_context, get_tenant_model
+from django_tenant_schemas_q.models import ScheduleIndex
+
+
+class Command(BaseCommand):
+    # Translators: help text for msscheduleindex management command
+    help = _(
+        "Rebuilds the public schedule index from the schedules of every tenant schema.")
+
+    def handle(self, *args, **options):
+        tenant_schemas_to_exclude = getattr(
+            settings, 'SCHEMAS_TO_BE_EXCLUDED_BY_SCHEDULER', ['public'])
+        tenants = get_tenant_model().objects.exclude(schema_name__in=tenant_schemas_to_exclude)
+        # the scheduler never sees an empty or half built index
+        with transaction.atomic():
+            ScheduleIndex.objects.all().delete()
+            for schema_name in tenants.values_list('schema_name', flat=True):
+                with schema_context(schema_name):
+                    schedules = Schedule.objects.exclude(repeats=0).exclude(next_run=None)
+                    ScheduleIndex.objects.bulk_create([
+                        ScheduleIndex(schema_name=schema_name, schedule_id=s.pk, next_run=s.next_run)
+                        for s in schedules
+                    ])
+        self.stdout.write(_(f"Indexed {ScheduleIndex.objects.count()} schedules"))
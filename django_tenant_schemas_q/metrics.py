@@ -0,0 +1,180 @@
+# Standard
+import threading
+from queue import Empty, Full
+from time import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local
+from django_q.conf import Conf, logger
+from django_tenant_schemas_q.conf import TenantConf
+
+
+class Metrics(object):
+    """
+    Counts and times the stages of the cluster per schema and function, and the memory growth of the tasks.
+    Every process aggregates its own observations and flushes them to the sentinel once per guard cycle,
+    so recording an observation never leaves the process.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.values = {}
+        self.flushed = time()
+        self.lock = threading.Lock()
+        self.table = None
+
+    def bind(self, queue):
+        """
+        Sends the observations of this process to the queue the sentinel collects them from
+        :type queue: multiprocessing.Queue
+        """
+        self.queue = queue
+        self.values = {}
+        self.flushed = time()
+        self.lock = threading.Lock()
+
+    def watch(self, table):
+        """
+        Reports the busy slots of the worker table with the totals
+        :type table: django_tenant_schemas_q.workers.WorkerTable
+        """
+        self.table = table
+
+    @property
+    def enabled(self):
+        return self.queue is not None
+
+    def observe(self, stage, seconds, schema_name="", func=""):
+        """
+        :param seconds: the duration of the stage, or the bytes of the memory_growth stage
+        """
+        if self.queue is None:
+            return
+        key = (stage, schema_name or "", func_label(func))
+        # thread and asyncio workers observe from several threads
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                self.values[key] = [1, seconds]
+            else:
+                value[0] += 1
+                value[1] += seconds
+        if time() - self.flushed >= Conf.GUARD_CYCLE:
+            self.flush()
+
+    def flush(self):
+        self.flushed = time()
+        if self.queue is None or not self.values:
+            return
+        with self.lock:
+            values, self.values = self.values, {}
+        try:
+            self.queue.put_nowait(values)
+        except Full:
+            # keep aggregating until the sentinel catches up
+            self.collect_values(values)
+
+    def collect(self, queue):
+        """
+        Merges the observations flushed by the cluster processes
+        """
+        while True:
+            try:
+                values = queue.get_nowait()
+            except Empty:
+                return
+            self.collect_values(values)
+
+    def collect_values(self, values):
+        with self.lock:
+            for key, (count, seconds) in values.items():
+                value = self.values.setdefault(key, [0, 0.0])
+                value[0] += count
+                value[1] += seconds
+
+    def render(self):
+        """
+        Returns the totals in the Prometheus text format
+        """
+        seconds_name = "django_tenant_schemas_q_stage_seconds"
+        bytes_name = "django_tenant_schemas_q_memory_growth_bytes"
+        seconds_lines = [
+            f"# HELP {seconds_name} Time spent in each stage of the cluster per schema and function",
+            f"# TYPE {seconds_name} summary",
+        ]
+        bytes_lines = [
+            f"# HELP {bytes_name} Resident memory a worker grew by running a task per schema and function",
+            f"# TYPE {bytes_name} summary",
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for (stage, schema_name, func), (count, total) in values:
+            labels = f'schema="{escape(schema_name)}",func="{escape(func)}"'
+            if stage == "memory_growth":
+                name, lines = bytes_name, bytes_lines
+            else:
+                name, lines = seconds_name, seconds_lines
+                labels = f'stage="{escape(stage)}",{labels}'
+            lines.append(f"{name}_count{{{labels}}} {count}")
+            lines.append(f"{name}_sum{{{labels}}} {total:.6f}")
+        return "\n".join(seconds_lines + bytes_lines + self.render_table()) + "\n"
+
+    def render_table(self):
+        if self.table is None:
+            return []
+        name = "django_tenant_schemas_q_busy_slots"
+        busy = {}
+        for row in self.table.scan():
+            if row["state"] == "busy":
+                key = (row["schema_name"], row["func"])
+                busy[key] = busy.get(key, 0) + 1
+        lines = [
+            f"# HELP {name} Worker slots running a task per schema and function",
+            f"# TYPE {name} gauge",
+        ]
+        for (schema_name, func), count in sorted(busy.items()):
+            lines.append(f'{name}{{schema="{escape(schema_name)}",func="{escape(func)}"}} {count}')
+        return lines
+
+
+# the metrics of the current process
+metrics = Metrics()
+
+
+def func_label(func):
+    if not func or isinstance(func, str):
+        return func or ""
+    return f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def serve(collector):
+    """
+    Serves the metrics of the collector over http on METRICS_PORT from a daemon thread
+    :type collector: Metrics
+    :return: the server, None if it couldn't be started
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = collector.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((TenantConf.METRICS_HOST, TenantConf.METRICS_PORT), Handler)
+    except OSError as e:
+        logger.error(e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
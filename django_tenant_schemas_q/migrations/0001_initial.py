@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('schema_name', models.CharField(max_length=63)),
+                ('schedule_id', models.IntegerField()),
+                ('next_run', models.DateTimeField(db_index=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Schedule index',
+                'verbose_name_plural': 'Schedule index',
+                'unique_together': {('schema_name', 'schedule_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Django
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class ScheduleIndex(models.Model):
+    """
+    Public schema index of the next run of every active schedule across all tenants
+    """
+
+    schema_name = models.CharField(max_length=63)
+    schedule_id = models.IntegerField()
+    next_run = models.DateTimeField(null=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.schema_name}:{self.schedule_id}"
+
+    class Meta:
+        app_label = "django_tenant_schemas_q"
+        verbose_name = _("Schedule index")
+        verbose_name_plural = _("Schedule index")
+        unique_together = ("schema_name", "schedule_id")
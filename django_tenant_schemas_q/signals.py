@@ -0,0 +1,27 @@
+# Django
+from django.db import connection
+
+# local
+from django_tenant_schemas_q.models import ScheduleIndex
+
+
+def index_schedule(sender, instance, **kwargs):
+    """
+    Keeps the public schedule index in sync with a saved schedule
+    """
+    schema_name = connection.schema_name
+    if instance.repeats == 0 or instance.next_run is None:
+        ScheduleIndex.objects.filter(schema_name=schema_name, schedule_id=instance.pk).delete()
+        return
+    ScheduleIndex.objects.update_or_create(
+        schema_name=schema_name,
+        schedule_id=instance.pk,
+        defaults={"next_run": instance.next_run},
+    )
+
+
+def unindex_schedule(sender, instance, **kwargs):
+    """
+    Removes a deleted schedule from the public schedule index
+    """
+    ScheduleIndex.objects.filter(schema_name=connection.schema_name, schedule_id=instance.pk).delete()
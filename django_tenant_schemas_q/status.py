@@ -0,0 +1,102 @@
+# Standard
+from time import time
+
+# Local
+from django_q.conf import Conf, logger
+from django_q.brokers import get_broker
+from django_q.brokers.redis_broker import Redis
+from django_q.signing import BadSignature, SignedPackage
+from django_q.status import Stat
+from django_tenant_schemas_q.conf import TenantConf
+
+
+# Drops the expired clusters from the registry and gets the status of the others in one go
+GET_ALL = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local keys = redis.call('ZRANGE', KEYS[1], 0, -1)
+if #keys == 0 then
+    return {}
+end
+return redis.call('MGET', unpack(keys))
+"""
+
+
+def registry_key():
+    # doesn't match the Q_STAT:* pattern Django Q reads the statuses with
+    return f"{Conf.Q_STAT}s"
+
+
+class StatusPublisher(object):
+    """
+    Publishes the status of a sentinel only when the state of its processes changes,
+    refreshing it every third of STATUS_TTL as a heartbeat
+    """
+
+    def __init__(self, sentinel):
+        self.sentinel = sentinel
+        self.state = None
+        self.published = 0
+
+    def snapshot(self):
+        """
+        The compact state of the cluster. Queue sizes aren't part of it, the heartbeat keeps them fresh enough
+        """
+        sentinel = self.sentinel
+        return (
+            sentinel.status(),
+            tuple(sorted(w.pid for w in sentinel.pool)),
+            sentinel.monitor.pid if sentinel.monitor else 0,
+            tuple(p.pid for p in sentinel.pushers),
+            sentinel.scheduler.pid if sentinel.scheduler else 0,
+            sentinel.reincarnations,
+        )
+
+    def publish(self, force=False):
+        state = self.snapshot()
+        if not force and state == self.state and time() - self.published < TenantConf.STATUS_TTL / 3:
+            return False
+        self.state = state
+        self.published = time()
+        stat = Stat(self.sentinel)
+        # what every worker slot is doing, read from the worker table
+        stat.worker_slots = self.sentinel.table.scan()
+        ttl = max(int(TenantConf.STATUS_TTL), 1)
+        try:
+            pack = SignedPackage.dumps(stat, True)
+            broker = stat.broker
+            if isinstance(broker, Redis):
+                pipe = broker.connection.pipeline(transaction=False)
+                pipe.set(stat.key, pack, ttl)
+                pipe.zadd(registry_key(), {stat.key: time() + ttl})
+                pipe.execute()
+            else:
+                broker.set_stat(stat.key, pack, ttl)
+        except Exception as e:
+            logger.error(e)
+        return True
+
+
+def get_all(broker=None):
+    """
+    Gets the status of all running clusters. Redis brokers read them with a single script call
+    instead of scanning the keyspace
+    :return: list of type Stat
+    """
+    if not broker:
+        broker = get_broker()
+    if not isinstance(broker, Redis):
+        return Stat.get_all(broker=broker)
+    try:
+        packs = broker.connection.register_script(GET_ALL)(keys=[registry_key()], args=[time()])
+    except Exception as e:
+        logger.error(e)
+        return Stat.get_all(broker=broker)
+    stats = []
+    for pack in packs:
+        if not pack:
+            continue
+        try:
+            stats.append(SignedPackage.loads(pack))
+        except BadSignature:
+            continue
+    return stats
@@ -0,0 +1,19 @@
+"""
+The template workers are forked from with WORKER_TEMPLATE. The multiprocessing fork server imports this module
+before forking any worker, so they all start with Django set up and the PRELOAD modules imported.
+"""
+import django
+from django_q.conf import logger
+
+try:
+    django.setup()
+    from django import db
+    from django_tenant_schemas_q.cluster import preload_modules
+
+    preload_modules()
+    # every worker opens its own connection
+    db.connections.close_all()
+except Exception:
+    # a broken template fails the fork server, the cluster can't spawn workers without it
+    logger.exception("worker template failed to set up")
+    raise
@@ -1,7 +1,11 @@
 # standard
-from multiprocessing import Value
+import asyncio
+from contextvars import ContextVar
+from weakref import WeakKeyDictionary
+from time import sleep, time
 
 # django
+from asgiref.sync import sync_to_async
 from django.db import connection
 from django.utils import timezone
 
@@ -10,9 +14,13 @@ from django_q.queues import Queue
 from django_q.humanhash import uuid
 from django_q.conf import Conf, logger
 from django_q.brokers import get_broker
+from django_q.brokers.redis_broker import Redis
 from django_q.signals import pre_enqueue
 from django_q.signing import SignedPackage
 from tenant_schemas.utils import schema_context
+from django_tenant_schemas_q.conf import TenantConf
+from django_tenant_schemas_q.brokers import FairRedis
+from django_tenant_schemas_q import codec, blobs
 from django_q.tasks import (schedule,
                             result,
                             result_group,
@@ -23,9 +31,39 @@ from django_q.tasks import (schedule,
                             delete_cached,
                             queue_size)
 
+# optional
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# asyncio redis clients are bound to the event loop they were created on
+async_connections = WeakKeyDictionary()
+
 
 class QUtilities(object):
 
+    # the schema of the coroutine task an asyncio worker slot is running
+    current_schema = ContextVar("current_schema", default=None)
+
+    @staticmethod
+    def tenant_sync_to_async(func):
+        """
+        Wraps a sync function, like a query, to be awaited from a coroutine task in the schema of the task.
+        Coroutine tasks share their thread with the other tasks of an asyncio worker
+        and can't rely on the connection schema
+        """
+        async def wrapper(*args, **kwargs):
+            schema_name = QUtilities.current_schema.get() or connection.schema_name
+
+            def call():
+                with schema_context(schema_name):
+                    return func(*args, **kwargs)
+
+            return await sync_to_async(call)()
+
+        return wrapper
+
     @staticmethod
     def prepare_task(func, *args, **kwargs):
         keywords = kwargs.copy()
@@ -41,6 +79,7 @@ class QUtilities(object):
             "chain",
             "broker",
             "timeout",
+            "fanout",
         )
         q_options = keywords.pop("q_options", {})
         # get an id
@@ -70,12 +109,13 @@ class QUtilities(object):
         if "ack_failure" not in task and Conf.ACK_FAILURES:
             task["ack_failure"] = Conf.ACK_FAILURES
         # finalize
+        task["args"], keywords = blobs.offload_arguments(task["args"], keywords, blobs.transient(task))
         task["kwargs"] = keywords
         task["started"] = timezone.now()
         # signal it
         pre_enqueue.send(sender="django_q", task=task)
         # sign it
-        pack = SignedPackage.dumps(task)
+        pack = codec.dumps(task)
         return tag, task, broker, pack
 
     @staticmethod
@@ -86,11 +126,150 @@ class QUtilities(object):
         tag, task, broker, pack = QUtilities.prepare_task(func, *args, **kwargs)
         if task.get("sync", False):
             return QUtilities.run_synchronously(pack)
-        enqueue_id = broker.enqueue(pack)
+        if isinstance(broker, FairRedis):
+            enqueue_id = broker.enqueue(pack, schema_name=kwargs["schema_name"])
+        else:
+            enqueue_id = broker.enqueue(pack)
         logger.info(f"Enqueued {enqueue_id}")
         logger.debug(f"Pushed {tag}")
         return task["id"]
 
+    @staticmethod
+    def async_connection():
+        """
+        Gets an asyncio redis client for the running event loop, None if the broker can't be reached with one
+        """
+        if aioredis is None or Conf.DJANGO_REDIS:
+            return None
+        loop = asyncio.get_running_loop()
+        client = async_connections.get(loop)
+        if client is None:
+            if isinstance(Conf.REDIS, str):
+                client = aioredis.from_url(Conf.REDIS)
+            else:
+                client = aioredis.Redis(**Conf.REDIS)
+            async_connections[loop] = client
+        return client
+
+    @staticmethod
+    async def aadd_async_task(func, *args, **kwargs):
+        """
+        Enqueues a task without blocking the event loop.
+        The schema name has to be passed explicitly as the connection schema isn't reliable in async code
+        """
+        if not kwargs.get("schema_name", None):
+            logger.error("No schema name was provided")
+            return None
+        # pre_enqueue receivers and the blob store may block
+        tag, task, broker, pack = await sync_to_async(QUtilities.prepare_task, thread_sensitive=False)(
+            func, *args, **kwargs)
+        if task.get("sync", False):
+            return await sync_to_async(QUtilities.run_synchronously)(pack)
+        await QUtilities.aenqueue_many(broker, [pack], [kwargs["schema_name"]])
+        logger.debug(f"Pushed {tag}")
+        return task["id"]
+
+    @staticmethod
+    async def aadd_async_tasks_bulk(func, args_list, chunk_size=None, **kwargs):
+        """
+        Enqueues a task for every set of arguments in args_list without blocking the event loop,
+        sending them to the broker in chunks of chunk_size
+        :return: the list of task ids
+        """
+        if not kwargs.get("schema_name", None):
+            logger.error("No schema name was provided")
+            return None
+        options = kwargs.get("q_options", kwargs)
+        options["broker"] = options.get("broker", None) or get_broker()
+        broker = options["broker"]
+        chunk_size = chunk_size or TenantConf.ENQUEUE_CHUNK_SIZE
+        task_ids = []
+        packs = []
+        for args in args_list:
+            if not isinstance(args, tuple):
+                args = (args,)
+            tag, task, broker, pack = await sync_to_async(QUtilities.prepare_task, thread_sensitive=False)(
+                func, *args, **kwargs)
+            task_ids.append(task["id"])
+            if task.get("sync", False):
+                await sync_to_async(QUtilities.run_synchronously)(pack)
+                continue
+            packs.append(pack)
+            if len(packs) >= chunk_size:
+                await QUtilities.aenqueue_many(broker, packs, [kwargs["schema_name"]] * len(packs))
+                packs = []
+        if packs:
+            await QUtilities.aenqueue_many(broker, packs, [kwargs["schema_name"]] * len(packs))
+        return task_ids
+
+    @staticmethod
+    async def aenqueue_many(broker, packs, schema_names):
+        """
+        Sends a list of packages to the broker without blocking the event loop
+        """
+        client = QUtilities.async_connection() if isinstance(broker, Redis) else None
+        if client is None:
+            return await sync_to_async(QUtilities.enqueue_many)(broker, packs, schema_names)
+        if isinstance(broker, FairRedis):
+            return await broker.aenqueue_many(client, packs, schema_names)
+        return await client.rpush(broker.list_key, *packs)
+
+    @staticmethod
+    async def aget_result(task_id, schema_name, wait=0, cached=Conf.CACHED):
+        # Async wrapper method to get result of a task in a schema
+        return await QUtilities.await_for(
+            sync_to_async(QUtilities.in_schema(schema_name, lambda *args: blobs.resolve(result(*args)))),
+            (task_id, 0, cached), [task_id], wait)
+
+    @staticmethod
+    async def afetch_task(task_id, schema_name, wait=0, cached=Conf.CACHED):
+        # Async wrapper method to fetch a single task in a schema
+        return await QUtilities.await_for(
+            sync_to_async(QUtilities.in_schema(schema_name, lambda *args: blobs.resolve_task(fetch(*args)))),
+            (task_id, 0, cached), [task_id], wait)
+
+    @staticmethod
+    def in_schema(schema_name, func):
+        # Wraps a function to run it in a schema
+        def wrapper(*args):
+            with schema_context(schema_name):
+                return func(*args)
+        return wrapper
+
+    @staticmethod
+    async def await_for(check, args, keys, wait=0, broker=None):
+        """
+        Awaits check(*args) until it returns a value or wait milliseconds have passed, forever for a negative wait.
+        The asyncio counterpart of wait_for, sleeping on redis pub/sub announcements without blocking the event loop
+        """
+        value = await check(*args)
+        if value or not wait:
+            return value
+        broker = broker or get_broker()
+        start = time()
+        pubsub = None
+        client = QUtilities.async_connection() if TenantConf.NOTIFY and isinstance(broker, Redis) else None
+        if client is not None:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(*[QUtilities.done_channel(broker, key) for key in keys])
+        try:
+            while True:
+                # check again once subscribed, the task might have finished in between
+                value = await check(*args)
+                if value:
+                    return value
+                remaining = wait / 1000 - (time() - start)
+                if wait >= 0 and remaining <= 0:
+                    return None
+                if pubsub:
+                    timeout = TenantConf.NOTIFY_POLL if wait < 0 else min(remaining, TenantConf.NOTIFY_POLL)
+                    await pubsub.get_message(timeout=timeout)
+                else:
+                    await asyncio.sleep(0.01)
+        finally:
+            if pubsub:
+                await pubsub.aclose() if hasattr(pubsub, "aclose") else await pubsub.close()
+
     @staticmethod
     def create_schedule(func, *args, **kwargs):
         # Wrapper method to create schedule with awareness of schema
@@ -109,28 +288,93 @@ class QUtilities(object):
         # Wrapper method to get result of a task with awareness of schema
         schema_name = connection.schema_name
         with schema_context(schema_name):
-            return result(task_id, wait, cached)
+            return QUtilities.wait_for(
+                lambda: blobs.resolve(result(task_id, 0, cached)), [task_id], wait)
 
     @staticmethod
     def get_result_group(group_id, failures=False, wait=0, count=None, cached=Conf.CACHED):
         # Wrapper method to get result of a group with awareness of schema
         schema_name = connection.schema_name
         with schema_context(schema_name):
-            return result_group(group_id, failures=False, wait=0, count=None, cached=Conf.CACHED)
+            return blobs.resolve(QUtilities.wait_for_group(
+                group_id, lambda: result_group(group_id, failures, 0, None, cached), wait, count, cached))
 
     @staticmethod
     def fetch_task(task_id, wait=0, cached=Conf.CACHED):
         # Wrapper method to fetch a single task with awareness of schema
         schema_name = connection.schema_name
         with schema_context(schema_name):
-            return fetch(task_id, wait, cached)
+            return QUtilities.wait_for(
+                lambda: blobs.resolve_task(fetch(task_id, 0, cached)), [task_id], wait)
 
     @staticmethod
     def fetch_task_group(group_id, failures=True, wait=0, count=None, cached=Conf.CACHED):
         # Wrapper method to get a group with tasks with awareness of schema
         schema_name = connection.schema_name
         with schema_context(schema_name):
-            return fetch_group(group_id, failures, wait, count, cached=cached)
+            return blobs.resolve_task(QUtilities.wait_for_group(
+                group_id, lambda: fetch_group(group_id, failures, 0, None, cached=cached), wait, count, cached))
+
+    @staticmethod
+    def wait_for_group(group_id, get, wait=0, count=None, cached=Conf.CACHED):
+        """
+        Waits until a group has count tasks and get returns a value.
+        The last value get returned is handed back as it is, even an empty one,
+        only a group that never reached count is queried once more for what it has
+        """
+        last = []
+
+        def check():
+            if QUtilities.group_complete(group_id, count, cached):
+                last[:] = [get()]
+                return last[0]
+
+        QUtilities.wait_for(check, [group_id], wait)
+        return last[0] if last else get()
+
+    @staticmethod
+    def group_complete(group_id, count, cached=Conf.CACHED):
+        # Whether a group has count tasks, always true without a count
+        return not count or count_group(group_id, cached=cached) >= count
+
+    @staticmethod
+    def done_channel(broker, key):
+        # The channel the monitor announces finished tasks on, by task id, name or group
+        return f"{broker.list_key}:done:{key}"
+
+    @staticmethod
+    def wait_for(check, keys, wait=0, broker=None):
+        """
+        Calls check until it returns a value or wait milliseconds have passed, forever for a negative wait.
+        With a redis broker it sleeps until the monitor announces a finished task for one of the keys,
+        checking at least every NOTIFY_POLL seconds. Other brokers are polled.
+        """
+        value = check()
+        if value or not wait:
+            return value
+        broker = broker or get_broker()
+        start = time()
+        pubsub = None
+        if TenantConf.NOTIFY and isinstance(broker, Redis):
+            pubsub = broker.connection.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*[QUtilities.done_channel(broker, key) for key in keys])
+        try:
+            while True:
+                # check again once subscribed, the task might have finished in between
+                value = check()
+                if value:
+                    return value
+                remaining = wait / 1000 - (time() - start)
+                if wait >= 0 and remaining <= 0:
+                    return None
+                if pubsub:
+                    timeout = TenantConf.NOTIFY_POLL if wait < 0 else min(remaining, TenantConf.NOTIFY_POLL)
+                    pubsub.get_message(timeout=timeout)
+                else:
+                    sleep(0.01)
+        finally:
+            if pubsub:
+                pubsub.close()
 
     @staticmethod
     def get_group_count(group_id, failures=False, cached=Conf.CACHED):
@@ -176,7 +420,8 @@ class QUtilities(object):
         # save the original arguments
         broker = options["broker"]
         broker.cache.set(
-            f"{broker.list_key}:{iter_group}:args", SignedPackage.dumps(args_iter)
+            f"{broker.list_key}:{iter_group}:args",
+            SignedPackage.dumps(blobs.offload(args_iter, bool(options.get("iter_cached", None)))),
         )
 
         for args in args_iter:
@@ -185,6 +430,52 @@ class QUtilities(object):
             QUtilities.add_async_task(func, *args, **options)
         return iter_group
 
+    @staticmethod
+    def add_async_tasks_bulk(func, args_list, chunk_size=None, **kwargs):
+        """
+        Enqueues a task for every set of arguments in args_list.
+        Packages are prepared in a tight loop and sent to the broker in chunks of chunk_size
+        with a single round trip per chunk where the broker allows it
+        :return: the list of task ids
+        """
+        if "schema_name" not in kwargs:
+            kwargs.update({"schema_name": connection.schema_name})
+        options = kwargs.get("q_options", kwargs)
+        options["broker"] = options.get("broker", None) or get_broker()
+        broker = options["broker"]
+        chunk_size = chunk_size or TenantConf.ENQUEUE_CHUNK_SIZE
+        task_ids = []
+        packs = []
+        for args in args_list:
+            if not isinstance(args, tuple):
+                args = (args,)
+            tag, task, broker, pack = QUtilities.prepare_task(func, *args, **kwargs)
+            task_ids.append(task["id"])
+            if task.get("sync", False):
+                QUtilities.run_synchronously(pack)
+                continue
+            packs.append(pack)
+            if len(packs) >= chunk_size:
+                QUtilities.enqueue_many(broker, packs, [kwargs["schema_name"]] * len(packs))
+                packs = []
+        if packs:
+            QUtilities.enqueue_many(broker, packs, [kwargs["schema_name"]] * len(packs))
+        logger.info(f"Enqueued {len(task_ids)} tasks")
+        return task_ids
+
+    @staticmethod
+    def enqueue_many(broker, packs, schema_names):
+        """
+        Sends a list of packages to the broker, in a single round trip for the redis brokers
+        :param schema_names: the schema of every package
+        """
+        if isinstance(broker, FairRedis):
+            return broker.enqueue_many(packs, schema_names)
+        if isinstance(broker, Redis):
+            return broker.connection.rpush(broker.list_key, *packs)
+        for pack in packs:
+            broker.enqueue(pack)
+
     @staticmethod
     def create_async_tasks_chain(chain, group=None, cached=Conf.CACHED, sync=Conf.SYNC, broker=None):
         """
@@ -215,13 +506,16 @@ class QUtilities(object):
         """Method to run a task synchoronously"""
 
         from django_tenant_schemas_q.cluster import worker, monitor
+        from django_tenant_schemas_q.workers import WorkerTable
 
         task_queue = Queue()
         result_queue = Queue()
-        task = SignedPackage.loads(pack)
+        task = codec.loads(pack)
         task_queue.put(task)
         task_queue.put("STOP")
-        worker(task_queue, result_queue, Value("f", -1))
+        # the worker leaves the connection in the schema of the task
+        with schema_context(connection.schema_name):
+            worker(task_queue, result_queue, WorkerTable(1).timer(0))
         result_queue.put("STOP")
         monitor(result_queue)
         task_queue.close()
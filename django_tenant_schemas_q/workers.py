@@ -0,0 +1,172 @@
+# Standard
+import ctypes
+from time import time
+from multiprocessing.sharedctypes import RawArray
+
+# Local
+from django_q.conf import logger
+
+
+IDLE = 0
+BUSY = 1
+RECYCLED = 2
+STATES = {IDLE: "idle", BUSY: "busy", RECYCLED: "recycled"}
+
+
+class Row(ctypes.Structure):
+    # a task slot of a worker, written by the worker running it and by the sentinel only before spawning it
+    _fields_ = [
+        # odd while the worker is writing the row
+        ("sequence", ctypes.c_uint64),
+        ("state", ctypes.c_int32),
+        ("pid", ctypes.c_int32),
+        # monotonic time the sentinel kills the worker at, -1 without a timeout
+        ("deadline", ctypes.c_double),
+        # wall clock time the task started at
+        ("started", ctypes.c_double),
+        ("processed", ctypes.c_uint64),
+        ("task_id", ctypes.c_char * 32),
+        ("schema_name", ctypes.c_char * 64),
+        ("func", ctypes.c_char * 128),
+        # the broker lease of the task, empty when it has none or it doesn't fit
+        ("ack_id", ctypes.c_char * 128),
+    ]
+
+
+class WorkerTable(object):
+    """
+    The task slots of all workers of a cluster in one block of shared memory. Every row has a single writer,
+    so the workers update their rows and the sentinel scans them without taking any lock.
+    """
+
+    def __init__(self, size):
+        self.rows = RawArray(Row, size)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def timer(self, index):
+        return Timer(self.rows, index)
+
+    def timers(self, start, count):
+        return [self.timer(index) for index in range(start, start + count)]
+
+    def scan(self):
+        """
+        A consistent copy of every row
+        :return: list of dicts
+        """
+        return [self.timer(index).snapshot() for index in range(len(self.rows))]
+
+
+class Timer(object):
+    """
+    The row of a worker slot. Named after the shared timer value it replaces
+    """
+
+    def __init__(self, rows, index):
+        self.rows = rows
+        self.index = index
+
+    @property
+    def row(self):
+        return self.rows[self.index]
+
+    @property
+    def state(self):
+        return self.row.state
+
+    @property
+    def deadline(self):
+        return self.row.deadline
+
+    @property
+    def ack_id(self):
+        # left out of the snapshots, the status doesn't publish broker leases
+        return self.row.ack_id.decode(errors="ignore")
+
+    def expired(self, now):
+        """
+        Whether the task of the slot is past its deadline
+        :param now: the current monotonic time
+        """
+        row = self.row
+        return row.state == BUSY and 0 < row.deadline <= now
+
+    def write(self, **fields):
+        row = self.row
+        row.sequence += 1
+        for name, value in fields.items():
+            setattr(row, name, value)
+        row.sequence += 1
+
+    def reset(self, pid=0):
+        """
+        Clears the row for a new worker, by the sentinel before spawning it and by the worker once it runs
+        """
+        self.write(
+            state=IDLE, pid=pid, deadline=-1, started=0, processed=0, task_id=b"", schema_name=b"", func=b"",
+            ack_id=b"",
+        )
+
+    def busy(self, task, deadline, schema_name="", func=""):
+        self.write(
+            state=BUSY,
+            deadline=deadline,
+            started=time(),
+            task_id=encode(task.get("id"), 32),
+            schema_name=encode(schema_name, 64),
+            func=encode(func, 128),
+            ack_id=whole(task.get("ack_id"), 128),
+        )
+
+    def idle(self, processed=False):
+        """
+        :param processed: the slot just finished a task
+        """
+        row = self.row
+        if processed:
+            self.write(state=IDLE, deadline=-1, processed=row.processed + 1)
+        elif row.state != IDLE:
+            self.write(state=IDLE, deadline=-1)
+
+    def recycle(self):
+        self.write(state=RECYCLED, deadline=-1)
+
+    def snapshot(self):
+        row = self.row
+        for __ in range(100):
+            sequence = row.sequence
+            if sequence % 2:
+                continue
+            snapshot = read(row)
+            if row.sequence == sequence:
+                return snapshot
+        logger.error(f"worker table row {self.index} kept changing while reading it")
+        return read(row)
+
+
+def read(row):
+    return {
+        "state": STATES.get(row.state, "unknown"),
+        "pid": row.pid,
+        "deadline": row.deadline,
+        "started": row.started,
+        "processed": row.processed,
+        "task_id": row.task_id.decode(errors="ignore"),
+        "schema_name": row.schema_name.decode(errors="ignore"),
+        "func": row.func.decode(errors="ignore"),
+    }
+
+
+def encode(value, size):
+    # the rows are fixed size, longer values are cut off
+    if not value:
+        return b""
+    return str(value).encode()[:size]
+
+
+def whole(value, size):
+    # a cut off value is useless, it isn't kept at all
+    value = encode(value, size + 1)
+    return value if len(value) <= size else b""
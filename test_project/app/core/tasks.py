@@ -7,3 +7,11 @@ def print_users_in_tenant():
 
 def print_emails_of_users_in_tenant():
     print([x.email for x in User.objects.all()])
+
+
+def count_users_in_tenant():
+    return User.objects.count()
+
+
+def add(total, value):
+    return total + value
@@ -1,20 +1,63 @@
 # Standard
+import os
+import sys
+import asyncio
+import signal
+import time
 import random
+import zlib
+import threading
+import multiprocessing
+import tempfile
+from multiprocessing import Event, Process
+from contextlib import contextmanager
+from queue import Queue as LocalQueue
+from urllib.request import urlopen
+from datetime import timedelta
+from decimal import Decimal
+from enum import Enum
+from uuid import UUID
 
 # Django
-from django.test import TransactionTestCase
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
 
 # Packages
+from django_q.conf import Conf
 from django_q.brokers import get_broker
-from tenant_schemas.utils import schema_context
-from django_tenant_schemas_q.custom import Chain
+from django_q.humanhash import uuid
+from django_q.models import Success, Task
+from django_q.queues import Queue
+from django_q.signals import pre_execute
+from django_q.signing import BadSignature
+from django_q.status import Stat
+from tenant_schemas.utils import get_tenant_model, schema_context
+from django_tenant_schemas_q.custom import Chain, FanOut
 from django_tenant_schemas_q.utils import QUtilities
+from django_tenant_schemas_q.models import ScheduleIndex
+from django_tenant_schemas_q.conf import TenantConf
+from django_tenant_schemas_q.cluster import (
+    Prefetch, Pruner, Record, Sentinel, SoftTimeout, affinity_tasks, alarm, async_worker, compact, dispatch, expand,
+    notify, overdue_schemas, preload_modules, pusher, resolve_func, save_tasks, share, soft_timeout, templated,
+    thread_worker, use_template, worker,
+)
+from django_tenant_schemas_q.workers import WorkerTable
+from django_tenant_schemas_q.metrics import Metrics, serve
+from django_tenant_schemas_q.status import get_all
+from django_tenant_schemas_q.brokers import FairRedis
+from django_tenant_schemas_q import blobs, codec
+from core import tasks
 
 
 class BaseSetup(TransactionTestCase):
 
     def setUp(self):
         print('Setting up tests')
+        # the flush after every test empties the tenant table, the tenant schemas stay
+        for schema_name in ['testone', 'testtwo']:
+            get_tenant_model().objects.get_or_create(schema_name=schema_name, defaults={
+                'domain_url': f'{schema_name}.testproject.localhost', 'name': schema_name})
 
     def test_async_task(self):
         with schema_context('testone'):
@@ -63,3 +106,738 @@ class BaseSetup(TransactionTestCase):
             print(len(task))
             assert len(task) == chain.length()
             broker.cache.clear()
+
+    def test_bulk_enqueue(self):
+
+        broker = get_broker()
+        broker.purge_queue()
+        numbers = list(range(1000))
+
+        with schema_context('testone'):
+            task_ids = QUtilities.add_async_tasks_bulk('math.floor', numbers, chunk_size=300, broker=broker)
+        with schema_context('testtwo'):
+            other_ids = QUtilities.add_async_tasks_bulk('math.floor', numbers[:10], broker=broker)
+
+        assert len(set(task_ids)) == len(numbers)
+        assert broker.queue_size() == len(numbers) + 10
+        packages = [codec.loads(pack) for pack in broker.connection.lrange(broker.list_key, 0, -1)]
+        schemas = {package['id']: package['kwargs']['schema_name'] for package in packages}
+        assert all(schemas[task_id] == 'testone' for task_id in task_ids)
+        assert all(schemas[task_id] == 'testtwo' for task_id in other_ids)
+        assert sorted(package['args'][0] for package in packages if schemas[package['id']] == 'testone') == numbers
+        broker.purge_queue()
+
+    def test_fanout(self):
+
+        broker = get_broker()
+        broker.purge_queue()
+
+        fanout = FanOut('core.tasks.count_users_in_tenant', reduce='core.tasks.add', initial=0, sync=True)
+        fanout.run()
+
+        assert fanout.total() == 2
+        assert fanout.completed() == fanout.total()
+        assert fanout.result(wait=1000) == 2
+
+    def test_schedule_index(self):
+
+        with schema_context('testone'):
+            schedule = QUtilities.create_schedule('core.tasks.print_users_in_tenant', schedule_type='D')
+            assert ScheduleIndex.objects.filter(schema_name='testone', schedule_id=schedule.pk).exists()
+
+            schedule.delete()
+            assert not ScheduleIndex.objects.filter(schema_name='testone', schedule_id=schedule.pk).exists()
+
+    def test_cluster_share(self):
+
+        schema_names = [f'tenant{i}' for i in range(20)]
+        cluster_ids = [uuid()[1] for __ in range(3)]
+        # every schema goes to exactly one cluster
+        shares = [share(schema_names, cluster_id, cluster_ids) for cluster_id in cluster_ids]
+        assert sorted(sum(shares, [])) == sorted(schema_names)
+
+        now = timezone.now()
+        ScheduleIndex.objects.create(
+            schema_name='testone', schedule_id=1, next_run=now - timedelta(seconds=TenantConf.SCHEDULER_INTERVAL + 60))
+        ScheduleIndex.objects.create(schema_name='testtwo', schedule_id=1, next_run=now)
+        with configured(SCHEDULE_INDEX=True):
+            overdue = overdue_schemas()
+        assert overdue == {'testone'}
+        # a schema that was missed is swept by every cluster, whatever they think the others are
+        for cluster_id in cluster_ids:
+            assert 'testone' in share(['testone', 'testtwo'], cluster_id, cluster_ids[:1], overdue)
+
+    def test_blobs_of_unsaved_tasks(self):
+
+        with blob_store(BLOB_THRESHOLD=100) as store, schema_context('testone'):
+            # save=False tasks never get a row
+            QUtilities.add_async_task('core.tasks.add', 'x' * 1000, 'y' * 1000, save=False, sync=True)
+            assert not blob_files(store)
+
+            # neither do successes with a negative SAVE_LIMIT
+            with configured(SAVE_LIMIT=-1):
+                QUtilities.add_async_task('core.tasks.add', 'x' * 1000, 'y' * 1000, sync=True)
+            assert not blob_files(store)
+
+    def test_blobs_of_retried_tasks(self):
+
+        broker = get_broker()
+        with blob_store(BLOB_THRESHOLD=100) as store:
+            task = {
+                'id': uuid()[1],
+                'name': 'retried',
+                'func': 'core.tasks.add',
+                'args': (),
+                'kwargs': {'schema_name': 'testone'},
+                'started': timezone.now(),
+                'stopped': timezone.now(),
+                'result': blobs.offload('failed' * 100),
+                'success': False,
+            }
+            save_tasks([task], broker)
+            failure = task['result']['__blob__']
+            assert failure in blob_files(store)
+
+            save_tasks([dict(task, result=blobs.offload('done' * 100), success=True)], broker)
+            assert failure not in blob_files(store)
+            with schema_context('testone'):
+                assert blobs.resolve_task(Task.objects.get(pk=task['id'])).result == 'done' * 100
+
+    def test_fair_dequeue(self):
+
+        broker = fair_broker()
+        try:
+            with configured(TENANT_WEIGHT=1, BULK=1):
+                # a flood of one tenant doesn't hold up the few tasks of another
+                broker.enqueue_many([f'one-{i}' for i in range(50)], ['testone'] * 50)
+                broker.enqueue_many(['two-0', 'two-1'], ['testtwo'] * 2)
+                tasks = [task.decode() for __ in range(4) for __, task in broker.dequeue()]
+                assert tasks == ['one-0', 'two-0', 'one-1', 'two-1']
+                assert broker.queue_size() == 48
+        finally:
+            broker.purge_queue()
+
+    def test_fair_parking(self):
+
+        broker = fair_broker()
+        try:
+            with configured(TENANT_MAX_IN_FLIGHT=1, BULK=10):
+                broker.enqueue_many(['one-0', 'one-1'], ['testone'] * 2)
+                [(ack_id, task)] = broker.dequeue()
+                assert task == b'one-0'
+
+                # at its cap the schema is parked instead of handing out its next task
+                assert not broker.dequeue()
+                assert broker.connection.sismember(broker.parked_key, 'testone')
+
+                broker.acknowledge(ack_id)
+                assert not broker.connection.sismember(broker.parked_key, 'testone')
+                [(ack_id, task)] = broker.dequeue()
+                assert task == b'one-1'
+                broker.acknowledge(ack_id)
+                assert not broker.connection.zcard(f"{broker.schema_queue('testone')}:inflight")
+        finally:
+            broker.purge_queue()
+
+    def test_fair_requeue(self):
+
+        broker = fair_broker()
+        try:
+            with configured(TENANT_WEIGHT=3, TENANT_MAX_IN_FLIGHT=3, BULK=3):
+                broker.enqueue_many(['one-0', 'one-1', 'one-2', 'one-3'], ['testone'] * 4)
+                prefetched = broker.dequeue()
+                assert [task for __, task in prefetched] == [b'one-0', b'one-1', b'one-2']
+
+                # tasks go back in front of the queue in the order they were dequeued, releasing their slots
+                broker.requeue([(ack_id, task, 'testone') for ack_id, task in prefetched])
+                assert broker.connection.lrange(broker.schema_queue('testone'), 0, -1) == [
+                    b'one-0', b'one-1', b'one-2', b'one-3']
+                assert not broker.connection.zcard(f"{broker.schema_queue('testone')}:inflight")
+                assert [task for __, task in broker.dequeue()] == [b'one-0', b'one-1', b'one-2']
+        finally:
+            broker.purge_queue()
+
+    def test_codec_round_trip(self):
+
+        package = codec_package()
+        for name in ['pickle', 'msgpack', 'orjson']:
+            if name != 'pickle' and not codec.available(name):
+                continue
+            data = codec.dumps(package, codec=name)
+            assert (data[:1] == codec.MAGIC) == (name != 'pickle')
+            assert codec.loads(data) == package
+
+    def test_codec_compression(self):
+
+        names = [name for name in ['msgpack', 'orjson'] if codec.available(name)]
+        package = dict(codec_package(), result='x' * 10000)
+        for name in names:
+            with configured(CODEC_COMPRESS_SIZE=0):
+                data = codec.dumps(package, codec=name)
+            assert not data[3] & codec.COMPRESSED
+            assert codec.loads(data) == package
+
+            if codec.zstandard:
+                with configured(CODEC_COMPRESS_SIZE=1000):
+                    compressed = codec.dumps(package, codec=name)
+                assert compressed[3] & codec.COMPRESSED
+                assert len(compressed) < len(data)
+                assert codec.loads(compressed) == package
+
+    def test_codec_signature(self):
+
+        for name in ['msgpack', 'orjson']:
+            if not codec.available(name):
+                continue
+            data = bytearray(codec.dumps(codec_package(), codec=name))
+            data[-1] ^= 1
+            with self.assertRaises(BadSignature):
+                codec.loads(bytes(data))
+
+    def test_codec_fallback(self):
+
+        # neither msgpack nor orjson serialize a Decimal, and they'd give back the others with another type
+        for args in [(Decimal('1.5'),), (UUID(uuid()[1]),), ((1, 2),), (Colour.RED,)]:
+            package = dict(codec_package(), args=args)
+            for name in ['msgpack', 'orjson']:
+                data = codec.dumps(package, codec=name)
+                assert data[:1] != codec.MAGIC, (name, args)
+                loaded = codec.loads(data)
+                assert loaded == package and type(loaded['args'][0]) is type(args[0])
+
+    def test_upsert_retried_task(self):
+
+        broker = get_broker()
+        task = finished_task(result='failed', success=False)
+        assert not save_tasks([task], broker)
+
+        # a retry overwrites the failure
+        assert not save_tasks([dict(task, result='done', success=True)], broker)
+        with schema_context('testone'):
+            row = Task.objects.get(pk=task['id'])
+            assert row.success and row.result == 'done'
+
+        # but a late failure never overwrites a success
+        assert not save_tasks([dict(task, result='late', success=False)], broker)
+        with schema_context('testone'):
+            row = Task.objects.get(pk=task['id'])
+            assert row.success and row.result == 'done'
+
+    def test_save_tasks_fallback(self):
+
+        broker = get_broker()
+        good = [finished_task(result=i) for i in range(3)]
+        # a lambda can't be pickled into the result column, failing the batch
+        bad = finished_task(result=lambda: 0)
+        assert save_tasks(good + [bad], broker) == {bad['id']}
+        with schema_context('testone'):
+            assert Task.objects.filter(pk__in=[task['id'] for task in good]).count() == len(good)
+            assert not Task.objects.filter(pk=bad['id']).exists()
+
+    def test_pruner(self):
+
+        broker = get_broker()
+        pruner = Pruner(interval=60, batch=10)
+        with configured(SAVE_LIMIT=5):
+            for schema_name in ['testone', 'testtwo']:
+                burst = [finished_task(kwargs={'schema_name': schema_name}) for __ in range(30)]
+                save_tasks(burst, broker, pruner)
+            # at most a batch per schema goes on every pass
+            for __ in range(20):
+                pruner.prune()
+            for schema_name in ['testone', 'testtwo']:
+                with schema_context(schema_name):
+                    assert Success.objects.count() == Conf.SAVE_LIMIT
+
+    def test_compact_round_trip(self):
+
+        broker = get_broker()
+        with blob_store(BLOB_THRESHOLD=1000, COMPACT_SHM_SIZE=100) as store:
+            # tasks the monitor needs in full aren't compacted
+            for task in [finished_task(cached=True), finished_task(result='failed', success=False)]:
+                assert compact(task) is task
+
+            grouped = finished_task(args=(1, 2), result=3, group='compacted')
+            # goes through shared memory
+            large = finished_task(result='x' * 500)
+            offloaded = finished_task(result=blobs.offload('y' * 5000))
+            records = [compact(dict(task)) for task in (grouped, large, offloaded)]
+            assert all(isinstance(record, Record) for record in records)
+            assert records[1].shm
+
+            assert not save_tasks([expand(record, broker) for record in records], broker)
+            with schema_context('testone'):
+                for task in (grouped, large, offloaded):
+                    row = blobs.resolve_task(Task.objects.get(pk=task['id']))
+                    assert row.args == task['args'] and row.group == task.get('group')
+                    assert row.result == blobs.resolve(task['result'])
+            assert offloaded['result']['__blob__'] in blob_files(store)
+
+            # a package that couldn't be decoded
+            assert expand(Record(None, None, None, None, None, None, None, None), broker) is None
+
+    def test_fair_bad_package(self):
+
+        broker = fair_broker()
+        __, task, __, pack = QUtilities.prepare_task('core.tasks.add', 1, 2, schema_name='testone')
+        # without a cap the tasks come without an ack id
+        with configured(TENANT_MAX_IN_FLIGHT=0, TENANT_WEIGHT=2, COMPACT_TRANSPORT=False):
+            broker.enqueue_many(['not a package', pack], ['testone'] * 2)
+            task_queue, event = Queue(), Event()
+            # a single pass
+            event.set()
+            pusher(task_queue, event, broker)
+        try:
+            assert task_queue.get(timeout=5)['id'] == task['id']
+        finally:
+            broker.purge_queue()
+
+    def test_workers(self):
+
+        for run, worker_type in [(worker, 'process'), (thread_worker, 'thread'), (async_worker, 'asyncio')]:
+            with configured(WORKER_TYPE=worker_type):
+                __, task, __, __ = QUtilities.prepare_task('core.tasks.add', 1, 2, schema_name='testone')
+                task_queue, result_queue = Queue(), Queue()
+                task_queue.put(task)
+                task_queue.put('STOP')
+                table = WorkerTable(1)
+                run(task_queue, result_queue, table.timer(0) if run is worker else table.timers(0, 1))
+                done = result_queue.get(timeout=5)
+                assert done['success'] and done['result'] == 3, worker_type
+                assert table.scan()[0]['processed'] == 1
+
+    def test_worker_errors(self):
+
+        def receiver(task, **kwargs):
+            if task['args'] == (0, 0):
+                raise RuntimeError('broken receiver')
+
+        # a receiver failing the first task doesn't take the worker down with it
+        pre_execute.connect(receiver)
+        try:
+            task_queue, result_queue = Queue(), Queue()
+            for args in [(0, 0), (1, 2)]:
+                task_queue.put(QUtilities.prepare_task('core.tasks.add', *args, schema_name='testone')[1])
+            task_queue.put('STOP')
+            worker(task_queue, result_queue, WorkerTable(1).timer(0))
+        finally:
+            pre_execute.disconnect(receiver)
+        failed, done = result_queue.get(timeout=5), result_queue.get(timeout=5)
+        assert not failed['success'] and 'broken receiver' in failed['result']
+        assert done['success'] and done['result'] == 3
+
+    def test_soft_timeout(self):
+
+        def handler(signum, frame):
+            pass
+
+        previous = signal.signal(signal.SIGALRM, handler)
+        signal.setitimer(signal.ITIMER_REAL, 100)
+        try:
+            with configured(TIMEOUT_GRACE=1):
+                # only the process workers of a cluster own SIGALRM
+                assert soft_timeout(0.05) == 0
+                with schema_context('testone'):
+                    QUtilities.add_async_task('core.tasks.add', 1, 2, sync=True, timeout=0.05)
+                assert signal.getsignal(signal.SIGALRM) is handler
+
+                with self.assertRaises(SoftTimeout):
+                    with alarm(soft_timeout(0.05, allowed=True)):
+                        time.sleep(1)
+            # the handler and what is left of the timer are back
+            assert signal.getsignal(signal.SIGALRM) is handler
+            assert 95 < signal.getitimer(signal.ITIMER_REAL)[0] <= 100
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    def test_affinity(self):
+
+        worker_queues = [Queue(maxsize=1), Queue(maxsize=1)]
+        tasks = [QUtilities.prepare_task('core.tasks.add', 1, 2, schema_name='testone')[1] for __ in range(2)]
+        owner = zlib.crc32(b'testone') % 2
+        # the owner of the schema gets the first task, the other worker the one that doesn't fit
+        for task in tasks:
+            dispatch(task, None, worker_queues)
+        assert worker_queues[owner].full() and worker_queues[1 - owner].full()
+
+        # a worker with an empty queue steals from the others
+        own_queue = Queue()
+        with configured(STEAL_WAIT=0.01):
+            stolen = affinity_tasks(own_queue, worker_queues)
+            assert {next(stolen)['id'], next(stolen)['id']} == {task['id'] for task in tasks}
+            own_queue.put('STOP')
+            assert list(stolen) == []
+
+    def test_schema_reset(self):
+
+        for keep, schema_name in [(False, 'public'), (True, 'testone')]:
+            with override_settings(TENANT_LIMIT_SET_CALLS=keep):
+                task_queue, result_queue = Queue(), Queue()
+                task_queue.put(QUtilities.prepare_task('core.tasks.add', 1, 2, schema_name='testone')[1])
+                task_queue.put('STOP')
+                worker(task_queue, result_queue, WorkerTable(1).timer(0))
+                assert result_queue.get(timeout=5)['success']
+                # the connection only stays in the schema of the task when asked to
+                assert connection.schema_name == schema_name
+            connection.set_schema_to_public()
+
+    def test_memory_recycle(self):
+
+        with configured(MAX_MEMORY=1, RECYCLE=100):
+            task_queue, result_queue = Queue(), Queue()
+            for args in [(1, 2), (3, 4)]:
+                task_queue.put(QUtilities.prepare_task('core.tasks.add', *args, schema_name='testone')[1])
+            table = WorkerTable(1)
+            # any worker outgrows a megabyte, it is recycled after its first task without a STOP
+            worker(task_queue, result_queue, table.timer(0))
+        assert result_queue.get(timeout=5)['result'] == 3
+        assert table.scan()[0]['state'] == 'recycled'
+        assert task_queue.get(timeout=5)['args'] == (3, 4)
+
+    def test_abandon(self):
+
+        broker = fair_broker()
+        try:
+            with configured(TENANT_MAX_IN_FLIGHT=1):
+                __, task, __, pack = QUtilities.prepare_task('core.tasks.add', 1, 2, schema_name='testone')
+                broker.enqueue_many([pack], ['testone'])
+                [(task['ack_id'], __)] = broker.dequeue()
+                sentinel = idle_sentinel(broker)
+                process = Process(target=time.sleep, args=(60,))
+                process.timers = sentinel.table.timers(0, 1)
+                process.start()
+                process.timers[0].busy(task, -1, 'testone', 'core.tasks.add')
+
+                # the worker is killed at the drain deadline and its task releases its lease
+                sentinel.abandon(process)
+                assert not process.is_alive()
+                assert not broker.connection.zcard(f"{broker.schema_queue('testone')}:inflight")
+        finally:
+            broker.purge_queue()
+
+    def test_resolve_func(self):
+
+        def takes_kwargs(**kwargs):
+            pass
+
+        resolve_func.cache_clear()
+        # a dotted path is imported once, the next tasks get it from the cache
+        assert resolve_func('core.tasks.add') == (tasks.add, False)
+        assert resolve_func('core.tasks.add') == (tasks.add, False)
+        assert resolve_func(takes_kwargs) == (takes_kwargs, True)
+        info = resolve_func.cache_info()
+        assert (info.hits, info.misses) == (1, 2)
+        with self.assertRaises(AttributeError):
+            resolve_func('core.tasks.missing')
+
+        # a module that can't be preloaded is logged, the worker starts anyway
+        with configured(PRELOAD=['core.tasks', 'core.missing']):
+            preload_modules()
+
+    def test_wait_for(self):
+
+        broker = get_broker()
+        task = finished_task()
+        done = threading.Event()
+
+        def finish():
+            time.sleep(0.2)
+            done.set()
+            notify([task], broker)
+
+        # the announcement wakes the waiting caller up long before its next poll
+        with configured(NOTIFY_POLL=30):
+            threading.Thread(target=finish).start()
+            started = time.time()
+            assert QUtilities.wait_for(done.is_set, [task['id']], wait=-1, broker=broker)
+            assert time.time() - started < 5
+            # without an announcement it gives up after wait milliseconds
+            started = time.time()
+            assert QUtilities.wait_for(lambda: None, [task['id']], wait=100, broker=broker) is None
+            assert 0.1 <= time.time() - started < 5
+
+    def test_async_api(self):
+
+        async def run():
+            assert await QUtilities.aadd_async_task('core.tasks.add', 1, 2) is None
+            task_id = await QUtilities.aadd_async_task('core.tasks.add', 1, 2, schema_name='testone', sync=True)
+            assert await QUtilities.aget_result(task_id, 'testone') == 3
+            assert (await QUtilities.afetch_task(task_id, 'testone')).success
+            # nothing was saved in the other schema
+            assert await QUtilities.aget_result(task_id, 'testtwo', wait=50) is None
+            return await QUtilities.aadd_async_tasks_bulk(
+                'core.tasks.add', [(1, 2), (3, 4), (5, 6)], chunk_size=2, schema_name='testone', broker=broker)
+
+        broker = get_broker()
+        broker.purge_queue()
+        try:
+            task_ids = asyncio.run(run())
+            assert len(set(task_ids)) == 3
+            assert broker.queue_size() == 3
+        finally:
+            broker.purge_queue()
+
+    def test_metrics(self):
+
+        flushed = LocalQueue()
+        worker_metrics, collector = Metrics(), Metrics()
+        # nothing is recorded until the process is bound to the sentinel
+        worker_metrics.observe('execute', 1)
+        worker_metrics.bind(flushed)
+        worker_metrics.observe('execute', 0.5, 'testone', tasks.add)
+        worker_metrics.observe('execute', 0.25, 'testone', tasks.add)
+        worker_metrics.observe('memory_growth', 4096, 'test"two', 'core.tasks.add')
+        worker_metrics.flush()
+        collector.collect(flushed)
+        table = WorkerTable(2)
+        table.timer(1).busy({'id': uuid()[1]}, -1, 'testone', 'core.tasks.add')
+        collector.watch(table)
+
+        with configured(METRICS_HOST='127.0.0.1', METRICS_PORT=0):
+            server = serve(collector)
+        try:
+            with urlopen(f'http://127.0.0.1:{server.server_address[1]}/') as response:
+                lines = response.read().decode().splitlines()
+        finally:
+            server.shutdown()
+        labels = 'schema="testone",func="core.tasks.add"'
+        assert f'django_tenant_schemas_q_stage_seconds_count{{stage="execute",{labels}}} 2' in lines
+        assert f'django_tenant_schemas_q_stage_seconds_sum{{stage="execute",{labels}}} 0.750000' in lines
+        growth = 'django_tenant_schemas_q_memory_growth_bytes_sum{schema="test\\"two",func="core.tasks.add"}'
+        assert f'{growth} 4096.000000' in lines
+        assert f'django_tenant_schemas_q_busy_slots{{{labels}}} 1' in lines
+
+    def test_status(self):
+
+        broker = get_broker()
+        sentinel = idle_sentinel(broker)
+        publisher = sentinel.publisher
+        try:
+            assert publisher.publish()
+            # nothing changed, the status isn't sent again until the heartbeat
+            assert not publisher.publish()
+            sentinel.reincarnations += 1
+            assert publisher.publish()
+            assert publisher.publish(force=True)
+            [stat] = [stat for stat in get_all(broker) if stat.cluster_id == sentinel.cluster_id]
+            assert stat.reincarnations == 1 and len(stat.worker_slots) == len(sentinel.table)
+        finally:
+            broker.connection.delete(Stat(sentinel).key)
+
+    def test_prefetch(self):
+
+        with configured(PREFETCH_WINDOW=1, RETRY=0, QUEUE_LIMIT=0, BULK=1):
+            prefetch = Prefetch(2)
+            # an idle task each and a second of work per worker, before there is a runtime to go by
+            assert prefetch.depth() == 4
+            prefetch.started()
+            prefetch.started()
+            assert prefetch.depth() == 2
+            prefetch.finished(0.5)
+            assert prefetch.depth() == 1 + 4
+            with configured(QUEUE_LIMIT=3):
+                assert prefetch.depth() == 3
+
+            broker = get_broker('prefetchtest')
+            broker.purge_queue()
+            for args in [(1, 2), (3, 4)]:
+                broker.enqueue(QUtilities.prepare_task('core.tasks.add', *args, schema_name='testone')[3])
+            prefetch = Prefetch(1)
+            prefetch.started()
+            task_queue, event = Queue(), Event()
+            task_queue.put('waiting')
+            pushing = threading.Thread(target=pusher, args=(task_queue, event, broker), kwargs={'prefetch': prefetch})
+            pushing.start()
+            try:
+                # the busy worker has its task waiting already, the pusher leaves the others in the broker
+                time.sleep(0.3)
+                assert broker.queue_size() == 2
+                # a worker frees up, the pusher wakes up and takes them
+                prefetch.finished(0.5)
+                for __ in range(50):
+                    if task_queue.qsize() == 3:
+                        break
+                    time.sleep(0.1)
+                assert task_queue.qsize() == 3 and not broker.queue_size()
+            finally:
+                event.set()
+                pushing.join(5)
+                broker.purge_queue()
+
+    def test_worker_template(self):
+
+        start_method = multiprocessing.get_start_method()
+        try:
+            with configured(WORKER_TEMPLATE=True, PRELOAD=['core.tasks']):
+                assert use_template()
+                assert multiprocessing.get_start_method() == 'forkserver'
+                # the queues have to be made for the fork server
+                task_queue, result_queue = Queue(), Queue()
+                task_queue.put(QUtilities.prepare_task('core.tasks.add', 1, 2, schema_name='testone')[1])
+                task_queue.put('STOP')
+                table = WorkerTable(1)
+                process = Process(target=templated, args=(worker, task_queue, result_queue, table.timer(0)))
+                process.start()
+                done = result_queue.get(timeout=30)
+                process.join(10)
+            assert done['success'] and done['result'] == 3
+            assert process.exitcode == 0 and table.scan()[0]['processed'] == 1
+        finally:
+            multiprocessing.set_start_method(start_method, force=True)
+
+    def test_guard_wait(self):
+
+        sentinel = idle_sentinel(get_broker())
+        timer = sentinel.table.timer(0)
+        process = Process(target=time.sleep, args=(0.2,))
+        process.timers = [timer]
+        sentinel.pool = [process]
+        process.start()
+        # the guard sleeps through its cycle unless something happens
+        started = time.monotonic()
+        sentinel.wait(30)
+        assert time.monotonic() - started < 5
+        process.join(5)
+        assert process.exitcode == 0
+
+        sentinel.pool = []
+        started = time.monotonic()
+        sentinel.deadlines_out.send_bytes(b'\0')
+        sentinel.wait(30)
+        assert time.monotonic() - started < 5 and not sentinel.deadlines.poll()
+
+        # a busy slot wakes it up at its deadline
+        process = Process(target=time.sleep, args=(30,))
+        process.timers = [timer]
+        sentinel.pool = [process]
+        process.start()
+        try:
+            timer.busy({'id': uuid()[1]}, time.monotonic() + 0.2, 'testone', 'core.tasks.add')
+            started = time.monotonic()
+            sentinel.wait(30)
+            assert 0.1 < time.monotonic() - started < 5 and timer.expired(time.monotonic())
+        finally:
+            process.terminate()
+            process.join()
+
+    def test_worker_table(self):
+
+        table = WorkerTable(2)
+        timer = table.timer(1)
+        pairs = {'a' * 32: 'testone', 'b' * 32: 'testtwo'}
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                for task_id, schema_name in pairs.items():
+                    timer.busy({'id': task_id}, -1, schema_name, 'core.tasks.add')
+
+        # a reader never sees a row the worker is halfway through writing, even switching threads all the time
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        writing = threading.Thread(target=write)
+        writing.start()
+        try:
+            for __ in range(2000):
+                row = timer.snapshot()
+                assert pairs[row['task_id']] == row['schema_name']
+        finally:
+            stop.set()
+            writing.join()
+            sys.setswitchinterval(interval)
+        assert table.scan()[0]['state'] == 'idle'
+
+        # values are cut to fit the row, except for the ack id which is useless cut off
+        timer.busy({'id': 'c' * 40, 'ack_id': 'd' * 200}, -1, 'x' * 100, 'core.tasks.add')
+        row = timer.snapshot()
+        assert row['task_id'] == 'c' * 32 and row['schema_name'] == 'x' * 64 and not timer.ack_id
+        timer.busy({'id': 'c' * 32, 'ack_id': 'testone:1'}, -1, 'testone', 'core.tasks.add')
+        assert timer.ack_id == 'testone:1'
+        timer.idle(processed=True)
+        assert timer.snapshot()['state'] == 'idle' and timer.snapshot()['processed'] == 1
+
+    def test_run_synchronously(self):
+
+        with schema_context('testone'):
+            task_id = QUtilities.add_async_task('core.tasks.add', 1, 2, sync=True)
+            assert QUtilities.fetch_task(task_id).success
+            assert QUtilities.get_result(task_id) == 3
+
+
+@contextmanager
+def configured(**options):
+    # sets TenantConf options, or Conf ones TenantConf doesn't have, for the block
+    saved = []
+    for name, value in options.items():
+        conf = TenantConf if hasattr(TenantConf, name) else Conf
+        saved.append((conf, name, getattr(conf, name)))
+        setattr(conf, name, value)
+    try:
+        yield
+    finally:
+        for conf, name, value in reversed(saved):
+            setattr(conf, name, value)
+
+
+def finished_task(**fields):
+    task = {
+        'id': uuid()[1],
+        'name': 'finished',
+        'func': 'core.tasks.add',
+        'args': (),
+        'kwargs': {'schema_name': 'testone'},
+        'started': timezone.now(),
+        'stopped': timezone.now(),
+        'result': None,
+        'success': True,
+    }
+    task.update(fields)
+    return task
+
+
+class Colour(str, Enum):
+    RED = 'red'
+
+
+def codec_package():
+    return {
+        'id': uuid()[1],
+        'name': 'codec',
+        'func': 'math.floor',
+        'args': (1, 'a', [2, 3]),
+        'kwargs': {'schema_name': 'testone', 'numbers': {'one': 1.5}},
+        'started': timezone.now(),
+    }
+
+
+def fair_broker():
+    broker = FairRedis(list_key='fairtest')
+    broker.purge_queue()
+    broker.publish_weights()
+    return broker
+
+
+def idle_sentinel(broker):
+    # a sentinel that doesn't start the cluster, it takes over SIGINT and SIGTERM though
+    handlers = [signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)]
+    try:
+        return Sentinel(Event(), Event(), uuid()[1], broker=broker, start=False)
+    finally:
+        signal.signal(signal.SIGINT, handlers[0])
+        signal.signal(signal.SIGTERM, handlers[1])
+
+
+@contextmanager
+def blob_store(**options):
+    # a file system blob store in a temporary directory, with the options set, for the block
+    store = blobs._store = blobs.FileSystemStore(tempfile.mkdtemp())
+    try:
+        with configured(**options):
+            yield store
+    finally:
+        blobs._store = None
+
+
+def blob_files(store):
+    return [name for __, __, files in os.walk(store.path) for name in files]
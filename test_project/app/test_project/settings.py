@@ -28,6 +28,7 @@ DEBUG = True
 # Application definition
 SHARED_APPS = [
     'tenants',
+    'django_tenant_schemas_q',
     'django.contrib.contenttypes'
 ]
 
@@ -176,6 +177,7 @@ Q_CLUSTER = {
     'bulk': 10,
     'log_level': 'DEBUG',
     'testing': True,
+    'schedule_index': True,
     'redis': {
         'host': 'redis',
         'port': 6379,